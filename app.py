@@ -1,22 +1,80 @@
+import gzip
+import hashlib
+import heapq
+import itertools
 import json
+import os
+import queue
+import signal
 import sys
+import tempfile
 import threading
 import time
-from datetime import datetime, timedelta
-from flask import Flask, render_template, request, jsonify
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta, timezone
+from flask import Flask, Response, request, jsonify
 import mock_rpi
+import control
+import metrics
+from channels import ChannelConfig, daily_windows
+from checkpoint import Checkpoint
+from filters import FilterPipeline
+from history import History
+from journal import Journal, JournalHandler
+from control import ControlServer, DaemonUnavailable
+from shared_state import SharedState
 import RPi.GPIO as GPIO
-import neopixel
-import board
-import adafruit_dht
-import smbus
 import logging
+import math
 import socket
 
-RETRY_COUNT = 5
+# センサーごとのサンプリング周期（秒）。値が変化している間は min、変化がなければ max まで延ばし、
+# コントローラーの動作中（running）は running 秒より長くしない
+SAMPLE_PERIODS = {
+    "dht": {"min": 4, "max": 120, "running": 30},          # DHT11（気温・湿度）。2秒以上空ける
+    "water_temp": {"min": 30, "max": 600, "running": 120},  # DS18B20（水温）。数分単位でしか変わらない
+    "adc": {"min": 2, "max": 60, "running": 10},           # PCF8591（EC・明るさ）。明るさは急に変わる
+}
+SAMPLE_BACKOFF = 1.5  # 値が変化しないときに周期を延ばす倍率
+# 変化したとみなす差（項目ごと）。前回周期を縮めたときの値からの差で判定する
+SAMPLE_CHANGE = {
+    "temperature": 1.0,  # DHT11の分解能は1℃、湿度の精度は±5%
+    "humidity": 5.0,
+    "water_temp": 0.2,
+    "ec_value": 0.05,
+    "brightness": 20,
+}
+# センサーごとの読み取り期限（秒）。期限を過ぎたセンサーは "timeout" として扱う
+SENSOR_TIMEOUTS = {
+    "dht": 3.0,
+    "water_temp": 2.0,
+    "adc": 1.0,
+}
+# センサーごとに得られる項目
+SENSOR_FIELDS = {
+    "dht": ("temperature", "humidity"),
+    "water_temp": ("water_temp",),
+    "adc": ("ec_value", "brightness"),
+}
+# 項目ごとの信号処理（外れ値の除外 → 平滑化 → 欠測の補完）。filters.SignalFilter を参照
+# filter: ("ema", 係数) / ("median", 件数) / ("kalman", 変化の分散, 測定の分散)
+# spike: (ロバストzスコアのしきい値, 最小スケール), max_gap: 直前の値で補完する最大秒数
+SIGNAL_FILTERS = {
+    "temperature": {"filter": ("median", 3), "spike": (4.0, 1.0), "max_gap": 120},
+    "humidity": {"filter": ("median", 3), "spike": (4.0, 2.0), "max_gap": 120},
+    "water_temp": {"filter": ("kalman", 0.001, 0.01), "spike": (4.0, 0.2), "max_gap": 300},
+    "ec_value": {"filter": ("ema", 0.3), "spike": (4.0, 0.05), "max_gap": 120},
+    "brightness": {"filter": ("ema", 0.5), "max_gap": 120},
+}
 SETTINGS_FILE = "settings.json"
-LOG_FILE = "cycle_switch.log"
-LOG_TO_FILE = True  # Trueならファイル出力、Falseならコンソール出力
+JOURNAL_DIR = "journal"
+HISTORY_FILE = "history.bin"
+CHECKPOINT_FILE = "checkpoint.bin"
+CHECKPOINT_MAX_AGE = 600  # これより古いチェックポイントからは出力を復元しない（秒）
+LOG_TO_FILE = True  # Trueならジャーナル（JOURNAL_DIR）に出力、Falseならコンソール出力
+# ジャーナルに記録するSSEイベントの種類（センサー値は履歴に記録するので除く）
+JOURNAL_EVENTS = ("state", "output")
 
 # GPIOピン設定
 OUTPUT_SSR1 = 6
@@ -26,27 +84,134 @@ OUTPUT_USB_LEFT_BOTTOM = 26
 OUTPUT_USB_RIGHT_TOP = 16
 OUTPUT_USB_RIGHT_BOTTOM = 19
 
+# 出力チャンネルの定義（書式は channels.py を参照）。CHANNELS_FILE があればそちらを使う
+CHANNELS_FILE = "channels.json"
+CHANNEL_CONFIG = {
+    "channels": {
+        "air": {"pins": [OUTPUT_SSR1], "schedule": {"cycle": "air"}},        # エアーポンプ
+        "left": {"pins": [OUTPUT_USB_LEFT_TOP, OUTPUT_USB_LEFT_BOTTOM],      # 前半の水中ポンプ
+                 "schedule": {"cycle": "left"}, "water": True},
+        "right": {"pins": [OUTPUT_USB_RIGHT_TOP, OUTPUT_USB_RIGHT_BOTTOM],   # 後半の水中ポンプ
+                  "schedule": {"cycle": "right"}, "water": True},
+        "aux": {"pins": [OUTPUT_SSR2], "schedule": None},                    # 予備（常にOFF）
+    },
+    "exclusive": [["left", "right"]],
+}
+channel_config = ChannelConfig.load(CHANNELS_FILE, CHANNEL_CONFIG)
+# 出力チャンネルとGPIOピンの対応（同じチャンネルのピンは同時に切り替える）
+OUTPUT_CHANNELS = channel_config.pins
+ALL_OFF = {channel: False for channel in OUTPUT_CHANNELS}
+# 動作サイクルの待機中の出力（時間帯で動くチャンネルには触れない）
+CYCLE_OFF = channel_config.cycle_outputs()
+
+# スケジューラーの最大待機時間（秒）。時計の補正があっても次の遷移を見失わないようにする
+MAX_SCHEDULER_WAIT = 60
+# 間隔の設定値の上限（分）と、1日の動作時間帯で繰り返すサイクル数の上限（タイムラインが大きくなりすぎないようにする）。
+# サイクル数が上限を超える設定は normalize_settings で受け付けません
+MAX_INTERVAL_MINUTES = 24 * 60
+MAX_DAY_CYCLES = 1440
+# スケジュールを先読みする日数（/api/transitions 用）
+TRANSITION_LOOKAHEAD_DAYS = 8
+# SSEで保持する直近イベント数と、無通信時のキープアライブ間隔（秒）
+EVENT_BUFFER_SIZE = 256
+STREAM_KEEPALIVE = 15
+
+# 制御デーモンとWebフロントエンドを分けて動かす場合の共有状態ブロックと制御ソケット
+STATE_FILE = os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+                          "cycle_switch.state")
+CONTROL_SOCKET = control.CONTROL_SOCKET
+STATE_HEARTBEAT = 1.0        # 変化がなくても共有状態を書き直す間隔（秒）
+STATE_STALE_SECONDS = 5.0    # この秒数更新がなければ制御デーモンが停止したとみなす
+STATE_POLL_INTERVAL = 0.2    # Webプロセスが共有状態の変化を確認する間隔（秒）
+WEB_WORKERS = 4              # Webフロントエンドのワーカープロセス数
+
+# 画面とファビコンのキャッシュ期間（秒）。期限後も ETag で確認するため、変更がなければ 304 を返す
+DASHBOARD_MAX_AGE = 300
+FAVICON_MAX_AGE = 30 * 24 * 3600
+# サーバーのIPアドレスを確認し直す間隔（秒）。経路表（/proc/net/route）が変わった場合だけ取得し直す
+ADDRESS_CHECK_INTERVAL = 30
+ROUTE_TABLE = "/proc/net/route"
+
 # 水位センサーのピン
 WATER_LEVEL_PIN = 15
+WATER_LEVEL_BOUNCETIME = 200  # チャタリング除去時間（ミリ秒）
+WATER_EVENT_HISTORY = 20  # 保持する水位変化イベントの件数
+# 水位低下時に停止する出力チャンネル（水中ポンプ）
+PUMP_CHANNELS = channel_config.water
+
+# NeoPixelのピン設定（board モジュールのピン名）
+NEOPIXEL_PIN = "D18"
+LED_PATTERN_STEP = 0.1  # 点滅・明滅パターンの更新間隔（秒）
+LED_BLINK_STEPS = 5     # 点滅の半周期（ステップ数）
+LED_PULSE_STEPS = 20    # 明滅の1周期（ステップ数）
+# 状態表示LEDの色（NeoPixelの並びに合わせた値）
+LED_COLORS = {
+    "blue": (0, 0, 50),
+    "green": (50, 0, 0),
+    "success": (50, 0, 0),
+    "yellow": (32, 32, 0),
+    "warning": (32, 32, 0),
+    "red": (0, 50, 0),
+    "danger": (0, 50, 0),
+    "cyan": (32, 0, 32),
+    "magenta": (0, 32, 32),
+    "white": (20, 20, 20),
+}
+
+class LazyDevice:
+    """
+    最初に使われたときに生成するハードウェアオブジェクト。
+    ハードウェアを使わない起動（off や Web フロントエンド）でライブラリの読み込みや初期化をしないようにします。
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self.device = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.device is None:
+                self.device = self.factory()
+            return self.device
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def close(self):
+        """生成済みの場合だけ閉じる"""
+        with self.lock:
+            if self.device is not None:
+                self.device.close()
+                self.device = None
+
+def create_dht_device():
+    import adafruit_dht
+    import board
+    return adafruit_dht.DHT11(board.D5, use_pulseio=False)  # GPIO5を使用
 
-# NeoPixelのピン設定
-NEOPIXEL_PIN = board.D18
+def create_bus():
+    import smbus
+    return smbus.SMBus(1)
 
 # DHT11センサーの設定
-dht_device = adafruit_dht.DHT11(board.D5, use_pulseio=False)  # GPIO5を使用
+dht_device = LazyDevice(create_dht_device)
 
 # 温度センサーのデバイスファイル
 DS18B20_DEVICE = "/sys/bus/w1/devices/28-01204c43b99b/w1_slave"
+# DS18B20の分解能（9〜12ビット）。11ビットは0.125℃刻みで、変換時間は12ビットの半分（375ms）
+DS18B20_RESOLUTION = 11
+DS18B20_RESOLUTION_FILE = os.path.join(os.path.dirname(DS18B20_DEVICE), "resolution")
 
 # PCF8591 の I2C アドレス（通常は 0x48）
 I2C_ADDR = 0x48
-bus = smbus.SMBus(1)
+bus = LazyDevice(create_bus)
 # 定数設定
 VREF = 5  # PCF8591のリファレンス電圧
 ADCRANGE = 255  # PCF8591は8ビットADC
 KVALUE = 1.0  # 校正係数（必要に応じて調整）
 TDS_FACTOR = 500  # TDSからECへの変換係数
 TEMP_COEFF = 0.02  # 温度補正係数（2% / ℃）
+ADC_OVERSAMPLE = 4  # 1回のサンプリングで平均するADC読み取り回数
 
 # 定数定義（control_enabledを追加）
 DEFAULT_SETTINGS = {
@@ -59,61 +224,534 @@ DEFAULT_SETTINGS = {
     "control_enabled": True
 }
 
+# メトリクス（/metrics で OpenMetrics 形式で出力）
+CALL_SECONDS = metrics.histogram(
+    "cycle_switch_call_seconds", "Duration of sensor, ADC and LED calls", ["function"])
+GPIO_WRITE_SECONDS = metrics.histogram(
+    "cycle_switch_gpio_write_seconds", "Duration of batched GPIO writes", ["level"])
+MAIN_CYCLE_SECONDS = metrics.histogram(
+    "cycle_switch_main_cycle_seconds", "Duration of main cycles (operating blocks)",
+    buckets=(60, 300, 600, 1800, 3600, 7200, 14400, 28800, 43200, 86400))
+SENSOR_FAILURES = metrics.counter(
+    "cycle_switch_sensor_failures", "Failed sensor reads", ["sensor", "status"])
+
 # グローバル変数
 logger = None
+# 構造化イベントのジャーナル（書き込みはバックグラウンドのスレッドが行う）
+journal = Journal(JOURNAL_DIR)
+metrics.callback("cycle_switch_journal_dropped", "Journal events dropped because the queue was full",
+                 "counter", [], lambda: [((), journal.dropped)])
+metrics.callback("cycle_switch_journal_write_errors", "Journal write batches that failed",
+                 "counter", [], lambda: [((), journal.errors)])
 
 # ログ設定
-def setup_logger():
+def setup_logger(to_journal=LOG_TO_FILE):
+    """
+    to_journal の場合はジャーナルに出力する（ジャーナルに書き込むプロセスは1つだけにする）。
+    それ以外はコンソールに出力します。
+    """
     global logger
     logger = logging.getLogger("SeedboxControl")  # ルートロガーを取得
     logger.setLevel(logging.INFO)    # ログレベルを設定
     # ハンドラー設定
-    if LOG_TO_FILE:
-        handler = logging.FileHandler(LOG_FILE, encoding="utf-8")
+    if to_journal:
+        journal.start()
+        handler = JournalHandler(journal)
     else:
-        handler = logging.StreamHandler(sys.stdout)
-    # フォーマット設定
-    formatter = logging.Formatter(
-        "%(asctime)s - %(levelname)s - %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S"
-    )
-    handler.setFormatter(formatter)
+        handler = logging.StreamHandler(sys.stderr)
+        # フォーマット設定
+        formatter = logging.Formatter(
+            "%(asctime)s - %(levelname)s - %(message)s",
+            datefmt="%Y-%m-%d %H:%M:%S"
+        )
+        handler.setFormatter(formatter)
     # ハンドラーをロガーに追加
     logger.addHandler(handler)
 
+class EventBroker:
+    """
+    サーバー送信イベント（SSE）の配信元。
+    イベントは発行時に1回だけエンコードしてリングバッファに置き、接続中の全クライアントで共有します。
+    クライアントに送るIDには起動（fork）ごとの識別子を付け、再起動前や別のワーカープロセスのIDと区別します。
+    """
+    def __init__(self, size=EVENT_BUFFER_SIZE):
+        self.condition = threading.Condition()
+        self.events = deque(maxlen=size)  # (イベントID, エンコード済みデータ)
+        self.last_id = 0
+        self.new_epoch()
+        os.register_at_fork(after_in_child=self.new_epoch)
+
+    def new_epoch(self):
+        self.epoch = os.urandom(4).hex()
+
+    def publish(self, event, data):
+        with self.condition:
+            self.last_id += 1
+            payload = f"id: {self.epoch}-{self.last_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+            self.events.append((self.last_id, payload.encode("utf-8")))
+            self.condition.notify_all()
+
+    def wait(self, last_id, timeout):
+        """last_id より新しいイベントを待って返す（タイムアウト時は空リスト）"""
+        with self.condition:
+            if self.last_id <= last_id:
+                self.condition.wait(timeout)
+            return [event for event in self.events if event[0] > last_id]
+
+    def resume_id(self, event_id):
+        """
+        クライアントの Last-Event-ID から再開するイベントIDを返す。
+        この配信元のIDでない場合（再起動前・別のプロセス・未来のID）は現在のIDから続けます。
+        """
+        epoch, _, number = (event_id or "").partition("-")
+        if epoch == self.epoch and number.isdigit() and int(number) <= self.last_id:
+            return int(number)
+        return self.last_id
+
+broker = EventBroker()
+
+def publish_event(event, data):
+    broker.publish(event, data)
+    if event in JOURNAL_EVENTS:
+        journal.emit(event, **data)
+
+def parse_time(time_str):
+    """"HH:MM" または "HH:MM:SS" 形式の時刻を読み取る"""
+    for fmt in ("%H:%M:%S", "%H:%M"):
+        try:
+            return datetime.strptime(time_str, fmt).time()
+        except (TypeError, ValueError):
+            pass
+    raise ValueError(f"Invalid time: {time_str}")
+
+def parse_minutes(value):
+    """
+    分単位の設定値を読み取る（小数を指定すると秒単位の間隔になる）。
+    値は秒単位に丸め、0 または 1秒以上 MAX_INTERVAL_MINUTES 分以下だけを受け付けます。
+    """
+    if isinstance(value, bool):
+        raise ValueError(f"Invalid interval: {value}")  # JSON の true/false は数値として受け付けない
+    try:
+        minutes = float(value)
+    except TypeError:
+        raise ValueError(f"Invalid interval: {value}")
+    if not math.isfinite(minutes) or minutes < 0 or minutes > MAX_INTERVAL_MINUTES:
+        raise ValueError(f"Invalid interval: {value}")
+    seconds = round(minutes * 60)
+    if minutes > 0 and seconds < 1:
+        raise ValueError(f"Interval is shorter than 1 second: {value}")
+    minutes = seconds / 60
+    return int(minutes) if minutes.is_integer() else minutes
+
+# 出力の切り替え1回分（時刻、フェーズ、動作状態、全チャンネルの出力）
+Transition = namedtuple("Transition", ["at", "phase", "state", "outputs"])
+
+class Schedule:
+    """
+    設定を出力切り替えのタイムラインに変換します。
+    日中は開始時刻から「前半ON → 後半ON → OFF」を繰り返し、終了時刻を過ぎたサイクルで止めます。
+    夜間動作時刻には前半ON・後半ONを1サイクルだけ実行します。
+    エアーポンプはサイクル実行中ずっとONです。
+    """
+    def __init__(self, settings):
+        self.settings = settings
+        self.start_time = parse_time(settings["start_time"])
+        self.end_time = parse_time(settings["end_time"])
+        self.night_times = sorted(parse_time(t) for t in settings.get("night_cycle_times", []))
+        self.left_seconds = settings["interval_output2_on"] * 60
+        self.right_seconds = settings["interval_output3_on"] * 60
+        self.off_seconds = settings["interval_both_off"] * 60
+        self.cache = {}
+
+    def cycle_segments(self, at, night=False):
+        """1サイクル分の(開始時刻, フェーズ, 出力)と、サイクルの終了時刻を返す"""
+        segments = []
+        if self.left_seconds > 0:
+            segments.append((at, "left", channel_config.cycle_outputs(air=True, left=True)))
+            at += timedelta(seconds=self.left_seconds)
+        if self.right_seconds > 0:
+            segments.append((at, "right", channel_config.cycle_outputs(air=True, right=True)))
+            at += timedelta(seconds=self.right_seconds)
+        if not night and self.off_seconds > 0:
+            segments.append((at, "off", channel_config.cycle_outputs(air=True)))
+            at += timedelta(seconds=self.off_seconds)
+        return segments, at
+
+    def blocks(self, day):
+        """指定日に開始する動作ブロック(開始, 終了, セグメント)の一覧"""
+        blocks = []
+        day_start = datetime.combine(day, self.start_time)
+        day_end = datetime.combine(day, self.end_time)
+        period = self.left_seconds + self.right_seconds + self.off_seconds
+        has_day = period > 0 and day_start <= day_end
+        if has_day:
+            at = day_start
+            segments = []
+            cycles = 0
+            while at <= day_end and cycles < MAX_DAY_CYCLES:
+                cycle, at = self.cycle_segments(at)
+                segments.extend(cycle)
+                cycles += 1
+            blocks.append((day_start, at, segments))
+        if self.left_seconds + self.right_seconds > 0:
+            for night_time in self.night_times:
+                night_start = datetime.combine(day, night_time)
+                if has_day and day_start <= night_start <= day_end:
+                    continue  # 日中の動作時間帯に含まれる
+                segments, night_end = self.cycle_segments(night_start, night=True)
+                blocks.append((night_start, night_end, segments))
+        blocks.sort(key=lambda block: block[0])
+        # 前のブロックと重なるブロックは実行しない
+        result = []
+        for block in blocks:
+            if result and block[0] < result[-1][1]:
+                continue
+            result.append(block)
+        return result
+
+    def transitions(self, day):
+        """指定日に開始するブロックの出力遷移を時刻順に返す"""
+        if day in self.cache:
+            return self.cache[day]
+        transitions = []
+        for block_start, block_end, segments in self.blocks(day):
+            for at, phase, outputs in segments:
+                if transitions and transitions[-1].phase == phase and transitions[-1].outputs == outputs:
+                    continue  # 出力が変わらない遷移は省く
+                transitions.append(Transition(at, phase, "running", outputs))
+            transitions.append(Transition(block_end, "idle", "waiting", dict(CYCLE_OFF)))
+        if len(self.cache) > 4:
+            self.cache.clear()
+        self.cache[day] = transitions
+        return transitions
+
+    def state_at(self, now):
+        """
+        指定時刻に有効な遷移（その時点の出力状態）を返す。
+        日付をまたぐブロックは翌日のブロックと重なることがあるため、制御スレッドと同じく時刻が最も遅い遷移を選びます
+        （同時刻なら後の日のもの）。
+        """
+        current = None
+        for day in (now.date() - timedelta(days=1), now.date()):
+            for transition in self.transitions(day):
+                if transition.at > now:
+                    break
+                if current is None or transition.at >= current.at:
+                    current = transition
+        return current or Transition(now, "idle", "waiting", dict(CYCLE_OFF))
+
+    def upcoming(self, now, count):
+        """指定時刻より後の遷移を時刻順に最大count件返す"""
+        result = []
+        day = now.date() - timedelta(days=1)
+        for i in range(TRANSITION_LOOKAHEAD_DAYS + 1):
+            result.extend(transition for transition in self.transitions(day) if transition.at > now)
+            day += timedelta(days=1)
+            # 以降の日のブロックはその日の0時から始まるため、それより前の遷移はここで確定する
+            midnight = datetime.combine(day, datetime.min.time())
+            if sum(1 for transition in result if transition.at < midnight) >= count:
+                break
+        result.sort(key=lambda transition: transition.at)
+        return result[:count]
+
+class ChannelTimer:
+    """
+    毎日の時間帯だけチャンネルをONにするタイムライン（Schedule と同じ形で遷移を返す）。
+    遷移の phase は "timer"、state は "on" / "off" です。時間帯が重なる場合はどれかに含まれる間ON。
+    """
+    def __init__(self, channel, windows):
+        self.channel = channel
+        self.windows = windows
+        self.cache = {}
+
+    def active(self, now):
+        """指定時刻がいずれかの時間帯（前日から続くものを含む）に含まれるか"""
+        return any(on_at <= now < off_at
+                   for day in (now.date() - timedelta(days=1), now.date())
+                   for on_at, off_at in daily_windows(self.windows, day))
+
+    def transition(self, at, on):
+        return Transition(at, "timer", "on" if on else "off", {self.channel: on})
+
+    def transitions(self, day):
+        """指定日に始まる時間帯の遷移を時刻順に返す"""
+        if day in self.cache:
+            return self.cache[day]
+        times = sorted(at for window in daily_windows(self.windows, day) for at in window)
+        transitions = [self.transition(at, self.active(at)) for at in times]
+        if len(self.cache) > 4:
+            self.cache.clear()
+        self.cache[day] = transitions
+        return transitions
+
+    def state_at(self, now):
+        return self.transition(now, self.active(now))
+
+    def upcoming(self, now, count):
+        result = []
+        day = now.date() - timedelta(days=1)
+        for i in range(TRANSITION_LOOKAHEAD_DAYS + 1):
+            result.extend(transition for transition in self.transitions(day) if transition.at > now)
+            day += timedelta(days=1)
+        result.sort(key=lambda transition: transition.at)
+        return result[:count]
+
+class SystemClock:
+    """実時間の時計"""
+    def now(self):
+        return datetime.now()
+
+    def time(self):
+        return time.time()
+
+    def wait(self, event, timeout):
+        return event.wait(timeout)
+
+SYSTEM_CLOCK = SystemClock()
+
+class VirtualClock:
+    """
+    シミュレーション用の仮想時計。
+    speed を指定するとその倍率で進み、None の場合は待機のたびに待機時間ぶん即座に進みます。
+    until を指定すると、その時刻に達した時点で finished をセットして進むのを止めます。
+    """
+    def __init__(self, start, speed=None, until=None):
+        self.start = start
+        self.speed = speed
+        self.until = until
+        self.origin = time.monotonic()
+        self.offset = 0.0  # 即座に進めた秒数
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+
+    def now(self):
+        elapsed = self.offset
+        if self.speed:
+            elapsed += (time.monotonic() - self.origin) * self.speed
+        now = self.start + timedelta(seconds=elapsed)
+        if self.until is not None and now >= self.until:
+            self.finished.set()
+            return self.until
+        return now
+
+    def time(self):
+        return self.now().timestamp()
+
+    def wait(self, event, timeout):
+        if self.speed:
+            return event.wait(timeout / self.speed)
+        if event.is_set():
+            return True
+        if self.finished.is_set():
+            return event.wait()  # 終了時刻に達したら停止されるまで待つ
+        with self.lock:
+            self.offset += timeout
+        self.now()
+        return event.is_set()
+
+class StatusLed:
+    """
+    状態表示LED（NeoPixel 1個）のドライバー。
+    NeoPixelは1回だけ初期化して使い続け、書き込みはワーカースレッドが行います。
+    現在と同じ表示の要求は捨てるため、呼び出し側をブロックしません。
+    pattern: "solid"（点灯）, "blink"（点滅）, "pulse"（明滅）
+    """
+    def __init__(self, pin):
+        self.pin = pin
+        self.pixels = None
+        self.requested = ("solid", "none")
+        self.shown = None
+        self.lock = threading.Lock()
+        self.commands = queue.Queue(maxsize=8)
+        self.thread = None  # 最初の表示要求で開始する
+
+    def set(self, color, pattern="solid"):
+        with self.lock:
+            if (pattern, color) == self.requested:
+                return
+            self.requested = (pattern, color)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.worker, daemon=True)
+                self.thread.start()
+        try:
+            self.commands.put_nowait((pattern, color))
+        except queue.Full:
+            pass  # ワーカーは最新の要求（self.requested）を参照する
+
+    def close(self):
+        self.set("none")
+        if self.thread is None:
+            return
+        self.commands.put(None)
+        self.thread.join(timeout=1)
+
+    def frame(self, pattern, color, step):
+        rgb = LED_COLORS.get(color, (0, 0, 0))
+        if pattern == "blink":
+            return rgb if (step // LED_BLINK_STEPS) % 2 == 0 else (0, 0, 0)
+        if pattern == "pulse":
+            phase = step % LED_PULSE_STEPS
+            scale = 1 - abs(phase - LED_PULSE_STEPS / 2) / (LED_PULSE_STEPS / 2)
+            return tuple(int(c * scale) for c in rgb)
+        return rgb
+
+    def worker(self):
+        pattern, color = "solid", "none"
+        step = 0
+        while True:
+            try:
+                command = self.commands.get(timeout=None if pattern == "solid" else LED_PATTERN_STEP)
+                if command is None:
+                    break
+                with self.lock:
+                    pattern, color = self.requested
+                step = 0
+            except queue.Empty:
+                step += 1
+            rgb = self.frame(pattern, color, step)
+            if rgb == self.shown:
+                continue
+            try:
+                with CALL_SECONDS.time(function="led_write"):
+                    if self.pixels is None:
+                        import board
+                        import neopixel
+                        self.pixels = neopixel.NeoPixel(getattr(board, self.pin), 1)
+                    self.pixels[0] = rgb
+                self.shown = rgb
+            except Exception as e:
+                logger.error("LED update error: %s", e)
+        if self.pixels is not None:
+            self.pixels[0] = (0, 0, 0)
+
 class Controller:
-    def __init__(self):
+    def __init__(self, clock=None, checkpoint=None):
+        self.clock = clock or SYSTEM_CLOCK  # 時刻の取得と待機（シミュレーションでは仮想時計）
+        self.checkpoint = checkpoint  # 状態のチェックポイント（None なら保存・復元しない）
+        self.resumed = None  # 起動時に復元したチェックポイント
         self.running = False
         self.thread = None
         self.exit_event = threading.Event()
+        self.wake_event = threading.Event()  # 設定変更時に待機中の制御スレッドを起こす
         self.lock = threading.RLock()
+        self.output_lock = threading.Lock()
         self.current_settings = None
+        self.schedule = None
+        # 時間帯で動くチャンネルのタイムライン（動作サイクルと同じ制御スレッドで切り替える）
+        self.timers = [ChannelTimer(channel, windows) for channel, windows in channel_config.daily.items()]
         self.control_enabled = False  # 全体制御ON/OFF状態
         self.operation_state = "stopped"  # "running", "waiting", "stopped"
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(OUTPUT_SSR1, GPIO.OUT)
-        GPIO.setup(OUTPUT_USB_LEFT_TOP, GPIO.OUT)
-        GPIO.setup(OUTPUT_USB_LEFT_BOTTOM, GPIO.OUT)
-        GPIO.setup(OUTPUT_USB_RIGHT_TOP, GPIO.OUT)
-        GPIO.setup(OUTPUT_USB_RIGHT_BOTTOM, GPIO.OUT)
-        self.stop_outputs()
+        self.phase = "idle"  # "left", "right", "off", "idle"
+        self.outputs = {}  # チャンネル名 -> 現在の出力
+        self.on_seconds = {channel: 0.0 for channel in OUTPUT_CHANNELS}  # チャンネルごとのON累計時間
+        self.on_since = {}  # ON中のチャンネル -> ONにした時刻（monotonic）
+        self.cycle_started = None
+        self.scheduled_outputs = dict(ALL_OFF)  # スケジュール上の出力（水位低下中も保持）
+        self.water_low = False
+        self.water_events = deque(maxlen=WATER_EVENT_HISTORY)
+        self.sensor_fault = False
+        self.led = StatusLed(NEOPIXEL_PIN)
+        self.hardware_ready = False
 
-        # 水位センサーの設定（リスナー登録）
-        GPIO.setup(WATER_LEVEL_PIN, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+    def setup(self):
+        """
+        GPIOを初期化する（出力はすべてOFF）。ハードウェアを扱うプロセスだけが呼びます。
+        Webフロントエンドのプロセスは import しても出力ピンに触れません。
+        再起動直後で有効なチェックポイントがあれば、その出力のまま初期化します（ポンプを止め直さない）。
+        ただし水位低下中はポンプをOFFで初期化します。
+        """
+        with self.lock:
+            if self.hardware_ready:
+                return
+            GPIO.setmode(GPIO.BCM)
+            # 出力ピンより先に水位を読む
+            GPIO.setup(WATER_LEVEL_PIN, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+            self.water_low = GPIO.input(WATER_LEVEL_PIN) == GPIO.HIGH  # 起動時の水位
+            restored = self.restore_checkpoint()
+            if restored is None:
+                GPIO.setup([pin for pins in OUTPUT_CHANNELS.values() for pin in pins], GPIO.OUT)
+                self.hardware_ready = True
+                self.stop_outputs()
+            else:
+                outputs = dict(restored)
+                if self.water_low:
+                    outputs.update({channel: False for channel in PUMP_CHANNELS})
+                for on in (False, True):
+                    pins = [pin for channel, pins in OUTPUT_CHANNELS.items() if outputs[channel] == on for pin in pins]
+                    if pins:
+                        GPIO.setup(pins, GPIO.OUT, initial=GPIO.HIGH if on else GPIO.LOW)
+                self.hardware_ready = True
+                with self.output_lock:
+                    self.outputs = outputs
+                    self.scheduled_outputs = dict(restored)
+                    for channel, on in outputs.items():
+                        self.count_on_time(channel, on)
+
+            # 水位センサーのリスナー登録
+            GPIO.add_event_detect(WATER_LEVEL_PIN, GPIO.BOTH, callback=self.on_water_level,
+                                  bouncetime=WATER_LEVEL_BOUNCETIME)
 
     def start(self, settings):
         with self.lock:
+            self.setup()
             if self.running:
                 self.stop()
             self.exit_event.clear()
+            self.wake_event.clear()
             self.current_settings = settings
+            self.schedule = Schedule(settings)
             self.running = True
             self.control_enabled = True
             self.operation_state = "waiting"  # 開始直後は待機状態
             self.thread = threading.Thread(target=self.control_loop)
             self.thread.start()
+            self.publish_state()
             logger.info("Controller started with settings: %s", settings)
 
+    def restore_checkpoint(self):
+        """
+        前回のチェックポイントが新しく、設定も変わっていなければ、チャンネルごとの出力を返す（それ以外は None）。
+        中断したフェーズの終了時刻を過ぎている場合も復元しません。
+        """
+        if self.checkpoint is None:
+            return None
+        try:
+            state = self.checkpoint.load()
+        except ValueError as e:
+            logger.warning("Checkpoint is not readable: %s", e)
+            return None
+        if state is None:
+            return None
+        now = self.clock.time()
+        if not 0 <= now - state["time"] <= CHECKPOINT_MAX_AGE:
+            return None
+        if state["etag"] != settings_store.get()[1]:
+            logger.info("Settings changed since the checkpoint; starting from the schedule")
+            return None
+        if state["deadline"] is not None and state["deadline"] <= now:
+            return None
+        self.resumed = state
+        return {channel: bool(state["outputs"].get(channel)) for channel in OUTPUT_CHANNELS}
+
+    def save_checkpoint(self):
+        """現在のフェーズ・次の切り替え時刻・出力をチェックポイントに預ける（書き込みは別スレッド）"""
+        if self.checkpoint is None:
+            return
+        schedule = self.schedule
+        deadline = None
+        if self.running and schedule is not None:
+            upcoming = schedule.upcoming(self.clock.now(), 1)
+            deadline = upcoming[0].at.timestamp() if upcoming else None
+        self.checkpoint.save({
+            "time": self.clock.time(),
+            "etag": settings_store.get()[1],
+            "operation": self.operation_state,
+            "phase": self.phase,
+            "deadline": deadline,
+            "outputs": dict(self.outputs),
+            "water_low": self.water_low,
+        })
+
     def stop(self):
         with self.lock:
             if self.running:
@@ -121,155 +759,409 @@ class Controller:
             self.running = False
             self.control_enabled = False
             self.operation_state = "stopped"
+            self.phase = "idle"
+            sampler.set_active(False)
             self.exit_event.set()
+            self.wake_event.set()
             if self.thread and self.thread.is_alive():
                 self.thread.join(timeout=3)
-            self.stop_outputs()
-            update_led("none")
+            if self.hardware_ready:
+                self.stop_outputs()
+            self.refresh_led()
+            self.publish_state()
+            self.save_checkpoint()
             logger.info("Controller stopped.")
 
+    def apply_settings(self, settings):
+        """
+        動作中のスケジュールに設定を反映する。制御スレッドは止めず、
+        実行中のフェーズは新しいタイムラインの次の遷移まで継続します。
+        """
+        with self.lock:
+            if not self.running:
+                self.start(settings)
+                return
+            changed = sorted(key for key in settings if settings[key] != self.current_settings.get(key))
+            if not changed:
+                return
+            self.current_settings = settings
+            self.schedule = Schedule(settings)
+            self.wake_event.set()
+            logger.info("Settings applied to running schedule (changed: %s)", ", ".join(changed))
+
     def stop_outputs(self):
-        GPIO.output(OUTPUT_SSR1, GPIO.LOW)
-        GPIO.output(OUTPUT_USB_LEFT_TOP, GPIO.LOW)
-        GPIO.output(OUTPUT_USB_LEFT_BOTTOM, GPIO.LOW)
-        GPIO.output(OUTPUT_USB_RIGHT_TOP, GPIO.LOW)
-        GPIO.output(OUTPUT_USB_RIGHT_BOTTOM, GPIO.LOW)
+        with self.output_lock:
+            self.output_pins(list(OUTPUT_CHANNELS), False)
+            for channel in OUTPUT_CHANNELS:
+                self.outputs[channel] = False
+                self.count_on_time(channel, False)
+            self.scheduled_outputs = dict(ALL_OFF)
+
+    def output_pins(self, channels, on):
+        """チャンネルのピンをまとめて1回のGPIO書き込みで切り替える"""
+        pins = [pin for channel in channels for pin in OUTPUT_CHANNELS[channel]]
+        if pins:
+            with GPIO_WRITE_SECONDS.time(level="high" if on else "low"):
+                GPIO.output(pins, GPIO.HIGH if on else GPIO.LOW)
+
+    def count_on_time(self, channel, on):
+        now = time.monotonic()
+        if on:
+            self.on_since.setdefault(channel, now)
+        elif channel in self.on_since:
+            self.on_seconds[channel] += now - self.on_since.pop(channel)
+
+    def output_on_seconds(self):
+        """チャンネルごとのON累計時間（ON中の経過時間を含む）"""
+        now = time.monotonic()
+        with self.output_lock:
+            return [((channel,), total + (now - self.on_since[channel] if channel in self.on_since else 0))
+                    for channel, total in self.on_seconds.items()]
+
+    def write_outputs(self, outputs):
+        """
+        変化したチャンネルだけを書き込む（output_lock を取得してから呼ぶ）。
+        同時にONにしないチャンネルの組を確認してから、OFF・ONをそれぞれ1回の書き込みで切り替えます。
+        """
+        outputs, blocked = channel_config.resolve(outputs, self.outputs)
+        if blocked:
+            logger.warning("Exclusive channels requested together, kept off: %s", blocked)
+        changed = {channel: on for channel, on in outputs.items() if self.outputs.get(channel) != on}
+        # ポンプが重ならないようOFFを先に行う
+        for on in (False, True):
+            self.output_pins([channel for channel, value in changed.items() if value == on], on)
+        for channel, on in changed.items():
+            self.outputs[channel] = on
+            self.count_on_time(channel, on)
+        return changed
+
+    def set_outputs(self, outputs):
+        """
+        スケジュール上の出力を設定する。水位低下中はポンプをOFFのままにします。
+        切り替えたチャンネルを返します。
+        """
+        with self.output_lock:
+            self.scheduled_outputs.update(outputs)
+            outputs = dict(self.scheduled_outputs)
+            if self.water_low:
+                outputs.update({channel: False for channel in PUMP_CHANNELS})
+            return self.write_outputs(outputs)
 
-    def parse_time(self, time_str):
-        return datetime.strptime(time_str, "%H:%M").time()
+    def on_water_level(self, channel):
+        """
+        水位センサーのエッジ検出コールバック。
+        水位低下を検出したらその場でポンプを止め、水位が戻ったらスケジュール上の出力に戻します。
+        """
+        low = GPIO.input(channel) == GPIO.HIGH
+        with self.output_lock:
+            if low == self.water_low:
+                return
+            self.water_low = low
+            changed = self.write_outputs({ch: False for ch in PUMP_CHANNELS}) if low else {}
+            self.water_events.append({"time": self.clock.time(), "level": "low" if low else "normal"})
+        if low:
+            logger.warning("Water level low: pumps stopped %s", list(changed))
+        else:
+            logger.info("Water level recovered: resuming schedule")
+            changed = self.set_outputs({})
+        if changed:
+            publish_event("output", {
+                "time": self.clock.time(),
+                "phase": self.phase,
+                "changed": changed,
+                "outputs": dict(self.outputs),
+            })
+        self.refresh_led()
+        self.publish_state()
+        self.save_checkpoint()
+
+    def set_sensor_fault(self, fault):
+        if fault != self.sensor_fault:
+            self.sensor_fault = fault
+            self.refresh_led()
+
+    def refresh_led(self):
+        if self.water_low:
+            self.led.set('red', "blink")      # 水位低下：赤の点滅
+        elif self.sensor_fault:
+            self.led.set('yellow', "pulse")   # センサー異常：黄の明滅
+        elif self.operation_state == "running":
+            self.led.set('green')  # 動作中：緑
+        elif self.operation_state == "waiting":
+            self.led.set('blue')   # 待機中：青
+        else:
+            self.led.set("none")
+
+    def publish_state(self):
+        publish_event("state", {
+            "operation": self.operation_state,
+            "phase": self.phase,
+            "control_enabled": self.control_enabled,
+            "water_level": "low" if self.water_low else "normal",
+        })
+
+    def apply_timer(self, transition):
+        """時間帯で動くチャンネルの遷移を適用する（動作サイクルの状態は変えない）"""
+        changed = self.set_outputs(transition.outputs)
+        if changed:
+            publish_event("output", {
+                "time": self.clock.time(),
+                "phase": self.phase,
+                "changed": changed,
+                "outputs": dict(self.outputs),
+            })
+            self.save_checkpoint()
+
+    def apply_transition(self, transition):
+        changed = self.set_outputs(transition.outputs)
+        phase_changed = self.phase != transition.phase
+        self.phase = transition.phase
+        if changed:
+            publish_event("output", {
+                "time": self.clock.time(),
+                "phase": transition.phase,
+                "changed": changed,
+                "outputs": dict(self.outputs),
+            })
+        if transition.state == self.operation_state:
+            if phase_changed:
+                self.publish_state()
+            self.save_checkpoint()
+            return
+        if transition.state == "running":
+            self.cycle_started = time.monotonic()
+            logger.info("Main cycle started at %s", self.clock.now().strftime("%H:%M:%S"))
+        elif self.operation_state == "running":
+            if self.cycle_started is not None:
+                MAIN_CYCLE_SECONDS.observe(time.monotonic() - self.cycle_started)
+                self.cycle_started = None
+            logger.info("Main cycle ended at %s", self.clock.now().strftime("%H:%M:%S"))
+        self.operation_state = transition.state
+        sampler.set_active(transition.state == "running")
+        self.refresh_led()
+        self.publish_state()
+        self.save_checkpoint()
+
+    def next_transitions(self, count):
+        """今後予定されている出力遷移を最大count件返す"""
+        schedule = self.schedule
+        if not self.running or schedule is None:
+            return []
+        now = self.clock.now()
+        transitions = schedule.upcoming(now, count)
+        for timer in self.timers:
+            transitions.extend(timer.upcoming(now, count))
+        return sorted(transitions, key=lambda transition: transition.at)[:count]
 
     def control_loop(self):
-        settings = self.current_settings
+        """
+        動作サイクルと各チャンネルのタイムラインの遷移を1つの優先度付きキューに積み、
+        次の遷移時刻までちょうど待機して出力を切り替える。
+        待機時間は毎回絶対時刻から計算するため、誤差は積み重ならない。
+        """
+        schedule = self.schedule
+        started_at = self.clock.now()
+        queue = []
+        sequence = itertools.count()
+        next_day = started_at.date() - timedelta(days=1)
 
-        start_time = self.parse_time(settings["start_time"])
-        end_time = self.parse_time(settings["end_time"])
-        night_times = [self.parse_time(t) for t in settings["night_cycle_times"]]
+        try:
+            # 途中から開始した場合も、その時点のフェーズから動作させる
+            current = schedule.state_at(started_at)
+            self.apply_transition(current)
+            for timer in self.timers:
+                self.apply_timer(timer.state_at(started_at))
+            resumed, self.resumed = self.resumed, None
+            if resumed is not None:
+                if resumed["phase"] == current.phase and resumed["operation"] == current.state:
+                    logger.info("Resumed phase %s from checkpoint", current.phase)
+                else:
+                    logger.info("Checkpoint phase %s superseded by scheduled phase %s", resumed["phase"], current.phase)
+        except Exception as e:
+            logger.error("Control loop error: %s", e)
+            return
 
         while self.running and not self.exit_event.is_set():
             try:
-                now = datetime.now().time().replace(second=0, microsecond=0)
-
-                # 制御対象の時間帯の場合
-                if (start_time <= now <= end_time) or (now in night_times):
-                    self.operation_state = "running"
-                    update_led('green')  # 動作中：緑
-                    logger.info("Main cycle started at %s", datetime.now().strftime("%H:%M:%S"))
-                    self.run_main_cycle(settings, start_time, end_time, night_times)
-                    logger.info("Main cycle ended at %s", datetime.now().strftime("%H:%M:%S"))
-                    # ルーチン終了後、まだ動作可能なら待機状態へ
-                    if self.running:
-                        self.operation_state = "waiting"
-                        update_led('blue')   # 待機中：青
-                else:
-                    self.stop_outputs()
+                if schedule is not self.schedule:
+                    # 設定が変更された：新しいタイムラインでキューを作り直す
+                    schedule = self.schedule
+                    started_at = self.clock.now()
+                    queue = []
+                    next_day = started_at.date() - timedelta(days=1)
+                    current = schedule.state_at(started_at)
+                    if current.state != self.operation_state:
+                        # 動作時間帯の内外が変わった場合だけ直ちに切り替える
+                        self.apply_transition(current)
 
-                now = datetime.now()
-                # 次の分の0秒までの秒数を計算
-                next_minute = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
-                wait_seconds = (next_minute - now).total_seconds()
+                # 翌日分までのタイムラインをキューに積む（0番が動作サイクル、以降がチャンネルのタイムライン）
+                timelines = [schedule] + self.timers
+                while next_day <= self.clock.now().date() + timedelta(days=1):
+                    for index, timeline in enumerate(timelines):
+                        for transition in timeline.transitions(next_day):
+                            if transition.at > started_at:
+                                heapq.heappush(queue, (transition.at, next(sequence), index, transition))
+                    next_day += timedelta(days=1)
 
-                # 最大1分の待機（早期解除可能）
-                self.exit_event.wait(wait_seconds)
+                now = self.clock.now()
+                wait_seconds = (queue[0][0] - now).total_seconds() if queue else MAX_SCHEDULER_WAIT
+                if wait_seconds > 0:
+                    # 次の遷移時刻まで待機（停止・設定変更で早期解除）
+                    self.clock.wait(self.wake_event, min(wait_seconds, MAX_SCHEDULER_WAIT))
+                    self.wake_event.clear()
+                    continue
+
+                # 期限を過ぎた遷移をまとめて取り出し、タイムラインごとに最新の状態だけを適用する
+                due = {}
+                while queue and queue[0][0] <= now:
+                    _, _, index, transition = heapq.heappop(queue)
+                    due[index] = transition
+                for index, transition in sorted(due.items()):
+                    if index == 0:
+                        self.apply_transition(transition)
+                    else:
+                        self.apply_timer(transition)
 
             except Exception as e:
                 logger.error("Control loop error: %s", e)
                 break
 
-    def run_main_cycle(self, settings, start_time, end_time, night_times):
-        GPIO.output(OUTPUT_SSR1, GPIO.HIGH)
+# コントローラーの初期化
+controller = Controller(checkpoint=Checkpoint(CHECKPOINT_FILE))
+metrics.callback("cycle_switch_output_on_seconds", "Total time each output channel has been on",
+                 "counter", ["channel"], controller.output_on_seconds)
+metrics.callback("cycle_switch_checkpoint_writes", "Controller checkpoint writes by result", "counter", ["result"],
+                 lambda: [(("ok",), controller.checkpoint.writes), (("error",), controller.checkpoint.errors)])
 
-        while self.running and not self.exit_event.is_set():
-            now = datetime.now().time().replace(second=0, microsecond=0)
-            if not ((start_time <= now <= end_time) or (now in night_times)):
-                break
+class SettingsConflict(Exception):
+    """If-Match のETagが現在の設定と一致しない（他の画面などで変更された）"""
 
-            # 出力2と3の交互制御
-            if settings["interval_output2_on"] > 0:
-                GPIO.output(OUTPUT_USB_LEFT_TOP, GPIO.HIGH)
-                GPIO.output(OUTPUT_USB_LEFT_BOTTOM, GPIO.HIGH)
-                if self.exit_event.wait(settings["interval_output2_on"] * 60):
-                    break
-                GPIO.output(OUTPUT_USB_LEFT_TOP, GPIO.LOW)
-                GPIO.output(OUTPUT_USB_LEFT_BOTTOM, GPIO.LOW)
-    
-            if settings["interval_output3_on"] > 0:
-                GPIO.output(OUTPUT_USB_RIGHT_TOP, GPIO.HIGH)
-                GPIO.output(OUTPUT_USB_RIGHT_BOTTOM, GPIO.HIGH)
-                if self.exit_event.wait(settings["interval_output3_on"] * 60):
-                    break
-                GPIO.output(OUTPUT_USB_RIGHT_TOP, GPIO.LOW)
-                GPIO.output(OUTPUT_USB_RIGHT_BOTTOM, GPIO.LOW)
+class SettingsStore:
+    """
+    設定をメモリ上に保持し、保存のたびにバージョンとETagを更新します。
+    ファイルへは一時ファイルに書いてから置き換えるため、書き込み途中で壊れることはありません。
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.settings = None
+        self.version = 0
+        self.etag = None
 
-            # 夜間モードの場合は1サイクルのみ実行
-            if now in night_times:
-                break
+    def set(self, settings):
+        encoded = json.dumps(settings, sort_keys=True).encode("utf-8")
+        self.settings = settings
+        self.version += 1
+        self.etag = hashlib.sha1(encoded).hexdigest()[:16]
 
-            if self.exit_event.wait(settings["interval_both_off"] * 60):
-                break
+    def load(self):
+        """設定ファイルを読み込む（検証できない設定の場合は初期設定で起動する）"""
+        try:
+            with open(self.path, "r") as f:
+                settings = json.load(f)
+            settings = validate_settings(settings)
+        except FileNotFoundError:
+            settings = DEFAULT_SETTINGS.copy()
+        except ValueError as e:
+            logger.warning("Invalid settings in %s, using defaults: %s", self.path, e)
+            settings = DEFAULT_SETTINGS.copy()
+        self.set(settings)
 
-        GPIO.output(OUTPUT_SSR1, GPIO.LOW)
+    def get(self):
+        """(設定のコピー, ETag, バージョン) を返す"""
+        with self.lock:
+            if self.settings is None:
+                self.load()
+            return dict(self.settings), self.etag, self.version
 
-# コントローラーの初期化
-controller = Controller()
-
-# 状態表示LED更新
-def update_led(color):
-    pixels = neopixel.NeoPixel(NEOPIXEL_PIN, 1)
-    if color == 'blue':
-            pixels[0] = (0, 0, 50)
-    elif color == 'green' or color == 'success':
-            pixels[0] = (50, 0, 0)
-    elif color == 'yellow' or color == 'warning':
-            pixels[0] = (32, 32, 0)
-    elif color == 'red' or color == 'danger':
-            pixels[0] = (0, 50, 0)
-    elif color == 'cyan':
-            pixels[0] = (32, 0, 32)
-    elif color == 'magenta':
-            pixels[0] = (0, 32, 32)
-    elif color == 'white':
-            pixels[0] = (20, 20, 20)
-    else:
-            pixels[0] = (0, 0, 0)
-    return True
+    def save(self, settings, if_match=None):
+        """
+        設定を保存して (ETag, バージョン) を返す。
+        if_match（ETagの一覧、"*" は任意）を指定した場合は、ロックを持ったまま現在のETagと照合します。
+        """
+        with self.lock:
+            if if_match is not None:
+                if self.settings is None:
+                    self.load()
+                if "*" not in if_match and self.etag not in if_match:
+                    raise SettingsConflict("Settings were changed")
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as f:
+                json.dump(settings, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+            self.set(dict(settings))
+            return self.etag, self.version
+
+settings_store = SettingsStore(SETTINGS_FILE)
 
 def load_settings():
-    try:
-        with open(SETTINGS_FILE, "r") as f:
-            settings = json.load(f)
-            settings.setdefault('night_cycle_times', [])
-            settings.setdefault('control_enabled', True)
-            return settings
-    except FileNotFoundError:
-        return DEFAULT_SETTINGS.copy()
-
-def save_settings(new_settings):
+    return settings_store.get()[0]
+
+def day_cycles(settings):
+    """日中の動作時間帯に実行するサイクル数（Schedule.blocks と同じ数え方）"""
+    # 間隔は秒単位に丸めてあるため、周期も整数の秒にする
+    period = round((settings["interval_output2_on"] + settings["interval_output3_on"] + settings["interval_both_off"]) * 60)
+    start = datetime.combine(datetime.min, parse_time(settings["start_time"]))
+    end = datetime.combine(datetime.min, parse_time(settings["end_time"]))
+    if period <= 0 or end < start:
+        return 0
+    return int((end - start).total_seconds() // period) + 1
+
+def normalize_settings(new_settings):
+    """画面から受け取った設定を検証し、保存する形式に整える（不正な値は ValueError）"""
+    if not isinstance(new_settings, dict):
+        raise ValueError("Settings must be a JSON object")
+    night_cycle_times = new_settings.get("night_cycle_times") or []
+    if not isinstance(night_cycle_times, list):
+        raise ValueError("night_cycle_times must be a list")
+    control_enabled = new_settings.get("control_enabled", True)
+    if not isinstance(control_enabled, bool):
+        raise ValueError("control_enabled must be true or false")
     settings = DEFAULT_SETTINGS.copy()
     settings.update({
         "start_time": new_settings.get("start_time", DEFAULT_SETTINGS["start_time"]),
         "end_time": new_settings.get("end_time", DEFAULT_SETTINGS["end_time"]),
-        "interval_output2_on": int(new_settings.get("interval_output2_on", DEFAULT_SETTINGS["interval_output2_on"])),
-        "interval_output3_on": int(new_settings.get("interval_output3_on", DEFAULT_SETTINGS["interval_output3_on"])),
-        "interval_both_off": int(new_settings.get("interval_both_off", DEFAULT_SETTINGS["interval_both_off"])),
-        "night_cycle_times": [t for t in new_settings.get("night_cycle_times", []) if t][:3],
-        "control_enabled": new_settings.get("control_enabled", True)
+        "interval_output2_on": parse_minutes(new_settings.get("interval_output2_on", DEFAULT_SETTINGS["interval_output2_on"])),
+        "interval_output3_on": parse_minutes(new_settings.get("interval_output3_on", DEFAULT_SETTINGS["interval_output3_on"])),
+        "interval_both_off": parse_minutes(new_settings.get("interval_both_off", DEFAULT_SETTINGS["interval_both_off"])),
+        "night_cycle_times": [t for t in night_cycle_times if t][:3],
+        "control_enabled": control_enabled
     })
+    for time_str in [settings["start_time"], settings["end_time"]] + settings["night_cycle_times"]:
+        parse_time(time_str)
+    cycles = day_cycles(settings)
+    if cycles > MAX_DAY_CYCLES:
+        raise ValueError(f"Too many cycles per day ({cycles}, max {MAX_DAY_CYCLES}): "
+                         "lengthen the intervals or shorten the operating hours")
     if settings.get("interval_output2_on") <= 0 and settings.get("interval_output3_on") <= 0 and settings.get("interval_both_off") <= 0:
         settings["control_enabled"] = False
-    
-    with open(SETTINGS_FILE, "w") as f:
-        json.dump(settings, f, indent=4)
-    logger.info("Settings saved: %s", settings)
-    
+    return settings
+
+def validate_settings(new_settings):
+    """設定を整え、試しにタイムラインを作って展開できることを確かめる（不正な値は ValueError）"""
+    settings = normalize_settings(new_settings)
+    Schedule(settings).transitions(datetime.now().date())
+    return settings
+
+def save_settings(new_settings, if_match=None):
+    settings = validate_settings(new_settings)
+    etag, version = settings_store.save(settings, if_match)
+    logger.info("Settings saved (version %d): %s", version, settings)
+    journal.emit("settings", version=version, etag=etag, settings=settings)
+
     if settings.get("control_enabled", True):
-        controller.start(settings)
+        controller.apply_settings(settings)
     else:
         controller.stop()
+    return etag
 
 # DS18B20から温度を読み取る関数
+@metrics.timed(CALL_SECONDS, function="read_temperature")
 def read_temperature():
     try:
-        with open(DS18B20_DEVICE, 'r') as f:
+        with mock_rpi.w1_open(DS18B20_DEVICE) as f:  # 実機では通常のファイルとして開く
             lines = f.readlines()
         # 最初の行に"YES"があれば読み取り成功
         if lines[0].strip()[-3:] != "YES":
@@ -283,40 +1175,619 @@ def read_temperature():
         logger.info("温度センサー読み取りエラー: " + str(e))
         return None
 
-def read_adc(channel=0):
+def set_temperature_resolution(bits=DS18B20_RESOLUTION):
+    """DS18B20の分解能を設定する（w1_therm ドライバーの resolution ファイル）"""
+    try:
+        mock_rpi.w1_write(DS18B20_RESOLUTION_FILE, str(bits))  # 実機では通常のファイルとして書き込む
+        logger.info("DS18B20 resolution set to %d bits", bits)
+    except OSError as e:
+        logger.warning("DS18B20 resolution could not be set: %s", e)
+
+class PCF8591:
+    """
+    PCF8591 A/Dコンバーターのドライバー。
+    自動インクリメントモードを使い、AIN0〜AIN3 を1回のブロック転送でまとめて読み取ります。
+    転送の先頭バイトは前回の変換結果なので読み捨てます（ダミーリードの代わり）。
+    """
+    CONTROL_AUTO_INCREMENT = 0x04  # 制御バイト：自動インクリメント、AIN0から開始
+    CHANNELS = 4
+    MAX_BLOCK = 32  # SMBusブロック転送の最大バイト数
+
+    def __init__(self, bus, address=I2C_ADDR, vref=VREF):
+        self.bus = bus
+        self.address = address
+        self.vref = vref
+        self.lock = threading.Lock()
+
+    @metrics.timed(CALL_SECONDS, function="read_adc")
+    def read_raw(self, oversample=1):
+        """全チャンネルの生の値（0-255、oversample回の平均）を配列で返す"""
+        sums = [0] * self.CHANNELS
+        per_block = (self.MAX_BLOCK - 1) // self.CHANNELS
+        remaining = oversample
+        with self.lock:
+            while remaining > 0:
+                count = min(remaining, per_block)
+                data = self.bus.read_i2c_block_data(
+                    self.address, self.CONTROL_AUTO_INCREMENT, 1 + count * self.CHANNELS)
+                for i, value in enumerate(data[1:]):
+                    sums[i % self.CHANNELS] += value
+                remaining -= count
+        return [total / oversample for total in sums]
+
+    def read_voltages(self, oversample=1):
+        """全チャンネルの電圧を配列で返す"""
+        return [value * self.vref / ADCRANGE for value in self.read_raw(oversample)]
+
+adc = PCF8591(bus)
+
+def read_adc(channel=0, oversample=1):
     """
-    PCF8591の指定チャンネルからアナログ値を取得（0-255の値を返す）
-    PCF8591は最初の読み出しが不正確な場合があるため、ダミーリードを行います。
+    PCF8591の指定チャンネルからアナログ値を取得し、電圧に変換して返します。
+    複数チャンネルが必要な場合は adc.read_voltages() でまとめて読み取ってください。
     """
-    bus.write_byte(I2C_ADDR, channel)
-    time.sleep(0.1)
-    bus.read_byte(I2C_ADDR)  # ダミーリード
-    value = bus.read_byte(I2C_ADDR)
-    return value * VREF / ADCRANGE # 電圧に変換
+    return adc.read_voltages(oversample)[channel]
 
-def get_ec(temperature=25):
+def get_ec(temperature=25, voltages=None):
     """
-    AIN3チャンネルからTDSセンサー（EC測定用）の値を取得し、
+    AIN2チャンネルからTDSセンサー（EC測定用）の値を取得し、
     温度補正を加えたEC値（電気伝導率）を計算して返します。
+    voltages に adc.read_voltages() の結果を渡すとバスを読まずにその値を使います。
     https://wiki.keyestudio.com/KS0429_keyestudio_TDS_Meter_V1.0
     """
-    raw_voltage = read_adc(channel=2)  # AIN2から値を取得
+    if temperature is None:
+        temperature = 25  # 水温が得られない場合は補正しない
+    raw_voltage = voltages[2] if voltages else read_adc(channel=2)  # AIN2から値を取得
     voltage = raw_voltage / (1.0+0.02*(temperature-25.0))
     ecValue = (133.42*voltage**3 - 255.86*voltage**2 + 857.39*voltage) / 500
     return ecValue
 
-def get_brightness():
+def get_brightness(voltages=None):
     """
     PCF8591モジュール内蔵の照度センサー（AIN0チャンネル接続）の値を取得します。
 
     生のADC値および電圧から、仮の換算式（電圧×100）で照度(lux)を計算します。
+    voltages に adc.read_voltages() の結果を渡すとバスを読まずにその値を使います。
     ※実際の換算はセンサーや回路の特性に合わせたキャリブレーションが必要です。
     """
-    voltage = read_adc(channel=0)  # 内蔵照度センサーはAIN0チャンネルに接続
+    voltage = voltages[0] if voltages else read_adc(channel=0)  # 内蔵照度センサーはAIN0チャンネルに接続
     lux = (VREF - voltage) * 100  # 仮の換算式（例：1V=100lux）
     # return raw_value, round(voltage, 3), round(lux, 3)
     return int(lux) 
 
+class SensorAcquisition:
+    """
+    独立したバス（DHT11のGPIO、1-Wire、I2C）のセンサーを並行して読み取ります。
+    センサーごとに期限を設け、期限内に読めたセンサーの値と、それ以外のエラー状態を返します。
+    全体の待ち時間は合計ではなく最も遅いセンサー1つ分になります。
+    """
+    def __init__(self, readers, timeouts):
+        self.readers = readers
+        self.timeouts = timeouts
+        # バスごとに1スレッド。応答しないセンサーがあってもスレッドは増えない
+        self.executor = ThreadPoolExecutor(max_workers=len(readers), thread_name_prefix="sensor")
+        self.pending = {}  # 期限切れでまだ終わっていない読み取り
+
+    def acquire(self, names):
+        """
+        指定センサーを並行して読み取り、センサー名 -> (状態, 値の辞書 or エラー文字列) を返す。
+        状態: "ok", "error", "timeout", "busy"（前回の読み取りがまだ終わっていない）
+        """
+        started = time.monotonic()
+        futures = {}
+        results = {}
+        for name in names:
+            pending = self.pending.get(name)
+            if pending is not None and not pending.done():
+                results[name] = ("busy", "previous read has not finished")
+                continue
+            self.pending.pop(name, None)
+            futures[name] = self.executor.submit(self.readers[name])
+
+        for name in sorted(futures, key=lambda name: self.timeouts[name]):
+            remaining = started + self.timeouts[name] - time.monotonic()
+            try:
+                results[name] = ("ok", futures[name].result(timeout=max(0, remaining)))
+            except FutureTimeoutError:
+                self.pending[name] = futures[name]
+                results[name] = ("timeout", f"no response within {self.timeouts[name]} s")
+            except Exception as e:
+                results[name] = ("error", str(e))
+        return results
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+class SamplingPeriod:
+    """
+    センサー1つ分の適応的なサンプリング周期。
+    読み取った値のどれかが SAMPLE_CHANGE 以上変化したら最短周期に戻し、
+    変化がなければ SAMPLE_BACKOFF 倍ずつ最長周期まで延ばします。読み取りに失敗した場合は最短周期で読み直します。
+    """
+    def __init__(self, config, fields):
+        self.min = config["min"]
+        self.max = config["max"]
+        self.running = config.get("running", self.max)
+        self.fields = fields
+        self.period = self.min
+        self.reference = {}  # 最後に変化とみなした時点の値
+
+    def update(self, values):
+        changed = False
+        for field in self.fields:
+            value = values.get(field)
+            if value is None:
+                continue
+            reference = self.reference.get(field)
+            if reference is None or abs(value - reference) >= SAMPLE_CHANGE.get(field, 0):
+                self.reference[field] = value
+                changed = True
+        self.period = self.min if changed else min(self.period * SAMPLE_BACKOFF, self.max)
+
+    def failed(self):
+        self.period = self.min
+
+    def current(self, active):
+        """現在の周期（active はコントローラーが動作中かどうか）"""
+        return min(self.period, self.running) if active else self.period
+
+class SensorSampler:
+    """
+    各センサーをそれぞれの周期で読み取り、最新値をメモリ上のスナップショットに保持するスレッド。
+    /api/status はセンサーを直接読まずにこのスナップショットを返します。
+    読み取りに失敗した項目は直前の値を残したまま、状態とエラー内容を記録します。
+    """
+    FIELDS = ("temperature", "humidity", "water_temp", "ec_value", "brightness")
+
+    def __init__(self, periods, timeouts, filters=None):
+        self.periods = {name: SamplingPeriod(config, SENSOR_FIELDS[name]) for name, config in periods.items()}
+        self.active = False  # コントローラーが動作中なら周期を短くする
+        self.wake_event = threading.Event()
+        self.filters = FilterPipeline(filters or {})
+        self.lock = threading.Lock()
+        self.acquire_lock = threading.Lock()
+        # フィールド名 -> {"value", "timestamp", "status", "error"}
+        self.samples = {}
+        self.thread = None
+        self.exit_event = threading.Event()
+        self.acquisition = SensorAcquisition({
+            "dht": self.sample_dht,
+            "water_temp": self.sample_water_temp,
+            "adc": self.sample_adc,
+        }, timeouts)
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.exit_event.clear()
+        self.thread = threading.Thread(target=self.sample_loop, daemon=True)
+        self.thread.start()
+        logger.info("Sensor sampler started with periods: %s",
+                    {name: (period.min, period.max) for name, period in self.periods.items()})
+
+    def stop(self):
+        self.exit_event.set()
+        self.wake_event.set()
+        if self.thread and self.thread.is_alive():
+            self.thread.join(timeout=3)
+        self.acquisition.shutdown()
+
+    def update(self, **values):
+        """測定値をフィルターに通して記録する。外れ値として除外した項目は "rejected" とする"""
+        now = time.time()
+        with self.lock:
+            values, rejected = self.filters.update(values, now)
+            for field, value in values.items():
+                self.samples[field] = {"value": value, "timestamp": now, "status": "ok", "error": None}
+        for field, value in values.items():
+            history.add(field, value, now)
+        publish_event("sample", {
+            "values": values,
+            "samples": {field: {"timestamp": now, "age": 0, "status": "ok"} for field in values},
+        })
+        if rejected:
+            self.mark_failed(rejected, "rejected", "spike rejected")
+
+    def mark_failed(self, fields, status, error):
+        """
+        読み取りに失敗した項目の状態を記録する。
+        値は直前のものを残しますが、補完できる期間（max_gap）を過ぎた値は None にします。
+        """
+        now = time.time()
+        cleared = {}
+        with self.lock:
+            for field in fields:
+                sample = self.samples.setdefault(field, {"value": None, "timestamp": None})
+                sample["status"] = status
+                sample["error"] = error
+                expired = field in self.filters.filters and self.filters.fill(field, now) is None
+                if expired and sample["value"] is not None:
+                    sample["value"] = cleared[field] = None
+        publish_event("sample", {
+            "values": cleared,
+            "samples": {field: {"status": status, "error": error} for field in fields},
+        })
+
+    def get(self, field, default=None):
+        with self.lock:
+            sample = self.samples.get(field)
+        if sample is None or sample["value"] is None:
+            return default
+        return sample["value"]
+
+    def snapshot(self):
+        """最新値と、フィールドごとの取得時刻・経過秒数・状態を返す"""
+        now = time.time()
+        with self.lock:
+            samples = {field: dict(sample) for field, sample in self.samples.items()}
+        values = {}
+        meta = {}
+        for field in self.FIELDS:
+            sample = samples.get(field, {})
+            timestamp = sample.get("timestamp")
+            values[field] = sample.get("value")
+            meta[field] = {
+                "timestamp": timestamp,
+                "age": None if timestamp is None else round(now - timestamp, 3),
+                "status": sample.get("status", "pending"),
+                "error": sample.get("error"),
+            }
+        return values, meta
+
+    @metrics.timed(CALL_SECONDS, function="dht_read")
+    def sample_dht(self):
+        """
+        DHT11を1回だけ読み取る。DHT11は2秒以内に読み直しても新しい値を返さないため、
+        失敗した場合はその場で繰り返さず、サンプリング周期の最短値で読み直します。
+        """
+        try:
+            temperature, humidity = dht_device.temperature, dht_device.humidity
+        except RuntimeError as e:
+            raise RuntimeError(f"DHT11 read failed: {e}")
+        if temperature is None or humidity is None:
+            raise RuntimeError("DHT11 returned no data")
+        return {"temperature": temperature, "humidity": humidity}
+
+    def sample_water_temp(self):
+        water_temp = read_temperature()
+        if water_temp is None:
+            raise RuntimeError("DS18B20 read failed")
+        return {"water_temp": water_temp}
+
+    def sample_adc(self):
+        voltages = adc.read_voltages(ADC_OVERSAMPLE)  # 全チャンネルを1回の転送で取得
+        return {
+            "ec_value": get_ec(self.get("water_temp", 25), voltages),
+            "brightness": get_brightness(voltages),
+        }
+
+    def sample(self, names):
+        """指定センサーを並行して読み取り、結果をスナップショットに反映する"""
+        with self.acquire_lock:
+            results = self.acquisition.acquire(names)
+        for name, (status, result) in results.items():
+            if status == "ok":
+                self.update(**result)
+            else:
+                SENSOR_FAILURES.inc(sensor=name, status=status)
+                journal.emit("sensor_error", sensor=name, status=status, error=result)
+                logger.info("Sensor sampling error (%s): %s: %s", name, status, result)
+                self.mark_failed(SENSOR_FIELDS[name], status, result)
+        return results
+
+    def refresh(self):
+        """全センサーをその場で読み取る（最も遅いセンサーの期限までで戻る）"""
+        self.sample(list(self.periods))
+
+    def set_active(self, active):
+        """コントローラーの動作状態を伝える（動作中は周期を短くする）"""
+        if active != self.active:
+            self.active = active
+            self.wake_event.set()  # 待機中の周期を計算し直す
+
+    def sample_periods(self):
+        """センサーごとの現在の周期（メトリクス用）"""
+        return [((name,), period.current(self.active)) for name, period in self.periods.items()]
+
+    def sample_loop(self):
+        last_read = {name: float("-inf") for name in self.periods}
+        faults = {}
+        while not self.exit_event.is_set():
+            now = time.monotonic()
+            next_due = {name: last_read[name] + period.current(self.active)
+                        for name, period in self.periods.items()}
+            due = [name for name, at in next_due.items() if now >= at]
+            if due:
+                for name, (status, result) in self.sample(due).items():
+                    faults[name] = status != "ok"
+                    period = self.periods[name]
+                    if status == "ok":
+                        period.update({field: self.get(field) for field in period.fields})
+                    elif status != "busy":
+                        period.failed()
+                for name in due:
+                    last_read[name] = time.monotonic()
+                controller.set_sensor_fault(any(faults.values()))
+                continue
+            # 次に読むべきセンサーの時刻まで待機（動作状態が変わったら計算し直す）
+            self.wake_event.wait(max(0, min(next_due.values()) - now))
+            self.wake_event.clear()
+
+# センサーサンプラーと履歴の初期化
+sampler = SensorSampler(SAMPLE_PERIODS, SENSOR_TIMEOUTS, SIGNAL_FILTERS)
+metrics.callback("cycle_switch_sample_period_seconds", "Current adaptive sampling period per sensor",
+                 "gauge", ["sensor"], sampler.sample_periods)
+history = History(HISTORY_FILE, SensorSampler.FIELDS)
+
+def transitions_json(transitions):
+    return [
+        {
+            "time": transition.at.isoformat(timespec="seconds"),
+            "phase": transition.phase,
+            "state": transition.state,
+            "outputs": transition.outputs,
+        }
+        for transition in transitions
+    ]
+
+def build_status():
+    values, meta = sampler.snapshot()
+
+    status = {
+        "operation": controller.operation_state,  # ここでフラグを返す
+        "phase": controller.phase,
+        "water_level": "low" if controller.water_low else "normal",
+        "water_events": list(controller.water_events),
+        "control_enabled": controller.control_enabled,
+        "samples": meta  # フィールドごとの取得時刻と経過秒数
+    }
+    status.update(values)
+    return status
+
+class LocalBackend:
+    """
+    同じプロセスのコントローラー・センサーを直接扱うバックエンド（on / daemon モード）。
+    制御ソケットのコマンドもこのクラスのメソッドで処理します。
+    """
+    COMMANDS = ("status", "settings", "save_settings", "transitions", "metrics", "start", "stop")
+
+    def status(self, refresh=False):
+        if refresh:
+            sampler.refresh()
+        return build_status()
+
+    def settings(self):
+        return settings_store.get()
+
+    def save_settings(self, settings, if_match=None):
+        """設定を保存して反映し、ETagを返す"""
+        return save_settings(settings, if_match)
+
+    def transitions(self, count):
+        return transitions_json(controller.next_transitions(count))
+
+    def metrics(self):
+        return metrics.REGISTRY.render()
+
+    def start(self):
+        settings = load_settings()
+        if not settings.get("control_enabled", True):
+            return False
+        # 動作中なら出力を止め直さずに設定だけ反映する
+        controller.apply_settings(settings)
+        return True
+
+    def stop(self):
+        controller.stop()
+        return True
+
+    def handle(self, command):
+        """制御ソケットで受け取ったコマンド {"command": 名前, "args": {...}} を実行する"""
+        name = command.get("command")
+        if name not in self.COMMANDS:
+            return {"status": "error", "message": f"Unknown command: {name}"}
+        try:
+            result = getattr(self, name)(**command.get("args", {}))
+        except SettingsConflict as e:
+            return {"status": "error", "message": str(e), "code": "conflict"}
+        except ValueError as e:
+            logger.info("Control command %s rejected: %s", name, e)
+            return {"status": "error", "message": str(e), "code": "invalid"}
+        except Exception as e:
+            logger.error("Control command %s failed: %s", name, e)
+            return {"status": "error", "message": str(e)}
+        return {"status": "success", "result": result}
+
+def state_snapshot():
+    """共有状態ブロックに書き込む内容"""
+    settings, etag, version = settings_store.get()
+    values, meta = sampler.snapshot()
+    water_event = controller.water_events[-1]["time"] if controller.water_events else None
+    return {
+        "operation": controller.operation_state,
+        "phase": controller.phase,
+        "control_enabled": controller.control_enabled,
+        "water_low": controller.water_low,
+        "outputs": dict(controller.outputs),
+        "settings_version": version,
+        "settings_etag": etag,
+        "water_event_time": water_event,
+        "event_id": broker.last_id,
+        "samples": {field: (values[field], meta[field]["timestamp"], meta[field]["status"])
+                    for field in SensorSampler.FIELDS},
+    }
+
+class StatePublisher:
+    """
+    制御デーモン側で、イベントが発行されるたびに状態を共有状態ブロックへ書き込むスレッド。
+    変化がなくても STATE_HEARTBEAT ごとに書き直し、読み取り側が生存を確認できるようにします。
+    """
+    def __init__(self, state):
+        self.state = state
+        self.exit_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.state.create()
+        self.state.write(state_snapshot())
+        self.thread = threading.Thread(target=self.publish_loop, daemon=True)
+        self.thread.start()
+        logger.info("Shared state published at %s", self.state.path)
+
+    def stop(self):
+        self.exit_event.set()
+        if self.thread:
+            self.thread.join(timeout=3)
+        self.state.close()
+
+    def publish_loop(self):
+        last_id = broker.last_id
+        while not self.exit_event.is_set():
+            events = broker.wait(last_id, STATE_HEARTBEAT)
+            if events:
+                last_id = events[-1][0]
+            try:
+                self.state.write(state_snapshot())
+            except Exception as e:
+                logger.error("Shared state update error: %s", e)
+
+class RemoteBackend:
+    """
+    別プロセスの制御デーモンを扱うバックエンド（web モード）。
+    状態は共有状態ブロックから直接読み、変更を伴う操作だけを制御ソケットで依頼します。
+    """
+    def __init__(self, state, socket_path):
+        self.state = state
+        self.socket_path = socket_path
+        self.settings_store = SettingsStore(SETTINGS_FILE)
+        self.lock = threading.Lock()
+        self.poller = None
+
+    def read_state(self):
+        with self.lock:
+            try:
+                if self.state.map is None:
+                    self.state.attach()
+                state = self.state.read()
+                if time.time() - state["updated"] > STATE_STALE_SECONDS:
+                    # デーモンが再起動していればブロックを開き直す
+                    self.state.close()
+                    self.state.attach()
+                    state = self.state.read()
+            except (OSError, ValueError) as e:
+                self.state.close()
+                raise DaemonUnavailable(f"Shared state is not available: {e}")
+        if time.time() - state["updated"] > STATE_STALE_SECONDS:
+            raise DaemonUnavailable("Control daemon is not updating the shared state")
+        return state
+
+    def call(self, command, **args):
+        """制御ソケットにコマンドを送り、結果を返す"""
+        return control.call(command, self.socket_path, **args)
+
+    def status(self, refresh=False):
+        if refresh:
+            return self.call("status", refresh=True)
+        state = self.read_state()
+        now = time.time()
+        status = {
+            "operation": state["operation"],
+            "phase": state["phase"],
+            "water_level": "low" if state["water_low"] else "normal",
+            "water_events": ([{"time": state["water_event_time"],
+                               "level": "low" if state["water_low"] else "normal"}]
+                             if state["water_event_time"] else []),
+            "control_enabled": state["control_enabled"],
+            "samples": {},
+        }
+        for field, (value, timestamp, sample_status) in state["samples"].items():
+            status[field] = value
+            status["samples"][field] = {
+                "timestamp": timestamp,
+                "age": None if timestamp is None else round(now - timestamp, 3),
+                "status": sample_status,
+                "error": None,
+            }
+        return status
+
+    def settings(self):
+        """設定ファイルは共有状態のETagが変わったときだけ読み直す"""
+        state = self.read_state()
+        with self.settings_store.lock:
+            if self.settings_store.settings is None or self.settings_store.etag != state["settings_etag"]:
+                self.settings_store.load()
+            settings = dict(self.settings_store.settings)
+        return settings, state["settings_etag"], state["settings_version"]
+
+    def save_settings(self, settings, if_match=None):
+        try:
+            return self.call("save_settings", settings=settings, if_match=if_match)
+        except control.CommandError as e:
+            # 検証エラーと前提条件の不一致は、ローカルで保存した場合と同じ例外にする
+            if e.code == "invalid":
+                raise ValueError(str(e))
+            if e.code == "conflict":
+                raise SettingsConflict(str(e))
+            raise
+
+    def transitions(self, count):
+        return self.call("transitions", count=count)
+
+    def metrics(self):
+        return self.call("metrics")
+
+    def start_poller(self):
+        with self.lock:
+            if self.poller is None:
+                self.poller = threading.Thread(target=self.poll_loop, daemon=True)
+                self.poller.start()
+
+    def poll_loop(self):
+        """共有状態の変化をこのプロセスのイベント（SSE）に変換する"""
+        previous = None
+        while True:
+            time.sleep(STATE_POLL_INTERVAL)
+            try:
+                state = self.read_state()
+            except DaemonUnavailable:
+                previous = None
+                continue
+            if previous is not None and state["seq"] != previous["seq"]:
+                self.publish_changes(previous, state)
+            previous = state
+
+    def publish_changes(self, previous, state):
+        keys = ("operation", "phase", "control_enabled", "water_low")
+        if any(previous[key] != state[key] for key in keys):
+            publish_event("state", {
+                "operation": state["operation"],
+                "phase": state["phase"],
+                "control_enabled": state["control_enabled"],
+                "water_level": "low" if state["water_low"] else "normal",
+            })
+        changed = {channel: on for channel, on in state["outputs"].items()
+                   if previous["outputs"].get(channel) != on}
+        if changed:
+            publish_event("output", {
+                "time": state["updated"],
+                "phase": state["phase"],
+                "changed": changed,
+                "outputs": state["outputs"],
+            })
+        values = {}
+        samples = {}
+        for field, (value, timestamp, status) in state["samples"].items():
+            if previous["samples"][field] == (value, timestamp, status):
+                continue
+            samples[field] = {"timestamp": timestamp, "status": status}
+            if status == "ok":
+                values[field] = value
+        if samples:
+            publish_event("sample", {"values": values, "samples": samples})
+
+# Webのリクエストを処理するバックエンド（web モードでは RemoteBackend に置き換える）
+backend = LocalBackend()
+
 # サーバーのローカルIPアドレスを取得
 def get_local_ip():
     try:
@@ -328,69 +1799,316 @@ def get_local_ip():
         print(f"IPアドレス取得エラー: {e}")
         return "127.0.0.1"
 
+class ServerAddress:
+    """
+    サーバーのIPアドレスを保持する。
+    ADDRESS_CHECK_INTERVAL ごとに経路表のハッシュを確認し、ネットワークが変わった場合だけ取得し直します。
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.address = None
+        self.routes = None
+        self.checked = 0
+
+    def route_hash(self):
+        try:
+            with open(ROUTE_TABLE, "rb") as f:
+                return hashlib.sha1(f.read()).digest()
+        except OSError:
+            return None
+
+    def get(self):
+        now = time.monotonic()
+        with self.lock:
+            if self.address is not None and now - self.checked < ADDRESS_CHECK_INTERVAL:
+                return self.address
+            self.checked = now
+            routes = self.route_hash()
+            if self.address is None or routes != self.routes:
+                address = get_local_ip()
+                if self.address is not None and address != self.address and logger:
+                    logger.info("Server address changed: %s -> %s", self.address, address)
+                self.address = address
+                self.routes = routes
+            return self.address
+
+server_address = ServerAddress()
+
+class StaticAsset:
+    """
+    起動時に読み込み、gzip圧縮を済ませておく静的ファイル。
+    リクエストごとにはファイルの読み込みもテンプレートの展開もせず、ETag・Last-Modified で 304 を返します。
+    """
+    def __init__(self, path, mimetype, max_age):
+        with open(path, "rb") as f:
+            self.data = f.read()
+        self.compressed = gzip.compress(self.data, compresslevel=9, mtime=0)
+        self.etag = hashlib.sha1(self.data).hexdigest()[:16]
+        self.last_modified = datetime.fromtimestamp(int(os.path.getmtime(path)), timezone.utc)
+        self.mimetype = mimetype
+        self.max_age = max_age
+
+    def response(self):
+        compressed = "gzip" in request.accept_encodings and len(self.compressed) < len(self.data)
+        response = Response(self.compressed if compressed else self.data, mimetype=self.mimetype)
+        if compressed:
+            response.content_encoding = "gzip"
+        # 圧縮の有無で内容が異なるため、ETag も分ける
+        response.set_etag(self.etag + ("-gz" if compressed else ""))
+        response.last_modified = self.last_modified
+        response.cache_control.public = True
+        response.cache_control.max_age = self.max_age
+        response.vary.add("Accept-Encoding")
+        return response.make_conditional(request)
+
 # Flaskアプリケーション設定
 app = Flask(__name__)
+dashboard = StaticAsset(os.path.join(app.root_path, "templates", "index.html"), "text/html", DASHBOARD_MAX_AGE)
+favicon = StaticAsset(os.path.join(app.root_path, "templates", "favicon.ico"), "image/vnd.microsoft.icon",
+                      FAVICON_MAX_AGE)
 
-# ルート：HTML画面の表示
+# ルート：HTML画面の表示（APIは相対URLで呼ぶため、サーバーのアドレスを埋め込む必要はない）
 @app.route('/')
 def index():
-    ip_address = get_local_ip()  # サーバーのIPアドレス取得
-    return render_template('index.html', server_ip=ip_address)
+    return dashboard.response()
+
+@app.route("/favicon.ico")
+def favicon_ico():
+    return favicon.response()
 
 @app.route("/api/settings", methods=["GET", "POST"])
 def settings_api():
     if request.method == "GET":
-        return jsonify(load_settings())
+        # メモリ上の設定を返す（ETagが一致すれば 304 Not Modified）
+        settings, etag, version = backend.settings()
+        response = jsonify(settings)
+        response.set_etag(etag)
+        response.headers["X-Settings-Version"] = str(version)
+        response.headers["Cache-Control"] = "no-cache"
+        return response.make_conditional(request)
     elif request.method == "POST":
-        new_settings = request.json
-        save_settings(new_settings)
-        return jsonify({"status": "success"})
+        # If-Match は保存と同じロックの中で照合する（同じETagでの同時の保存は1つだけ成功する）
+        if_match = None
+        if request.if_match:
+            if_match = ["*"] if request.if_match.star_tag else sorted(request.if_match.as_set())
+        try:
+            etag = backend.save_settings(request.get_json(silent=True), if_match)
+        except SettingsConflict as e:
+            return jsonify({"status": "error", "message": str(e)}), 412
+        except ValueError as e:
+            # 検証に失敗した設定は保存しない
+            return jsonify({"status": "error", "message": str(e)}), 400
+        response = jsonify({"status": "success"})
+        response.set_etag(etag)
+        return response
+
+@app.route("/api/transitions", methods=["GET"])
+def transitions_api():
+    count = min(max(request.args.get("count", 10, type=int), 1), 100)
+    return jsonify(backend.transitions(count))
 
 @app.route("/api/status", methods=["GET"])
 def status_api():
-    water_level = "low" if GPIO.input(WATER_LEVEL_PIN) == GPIO.HIGH else "normal"
+    # refresh=1 の場合はその場で全センサーを並行して読み取る
+    status = backend.status(refresh=bool(request.args.get("refresh", type=int)))
+    status["server_address"] = server_address.get()
+    return jsonify(status)
 
-    for i in range(RETRY_COUNT):
-        try:
-            temperature = dht_device.temperature
-            humidity = dht_device.humidity
-            break
-        except RuntimeError:
-            pass
+@app.route("/metrics", methods=["GET"])
+def metrics_api():
+    return Response(backend.metrics(), mimetype=metrics.CONTENT_TYPE)
 
-    water_temp = read_temperature()
-    ec_value = get_ec(water_temp)
-    brightness = get_brightness()
+@app.route("/api/history", methods=["GET"])
+def history_api():
+    """センサー値の履歴を一定幅のバケット（最小・最大・平均）で返す"""
+    now = time.time()
+    end = request.args.get("to", now, type=float)
+    start = request.args.get("from", end - 24 * 3600, type=float)
+    step = request.args.get("step", max(60, (end - start) / 288), type=float)
+    try:
+        result = history.query(request.args.get("metric", ""), start, end, step)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify(result)
 
-    status = {
-        "operation": controller.operation_state,  # ここでフラグを返す
-        "water_level": water_level,
-        "humidity": humidity,
-        "temperature": temperature,
-        "water_temp": water_temp,
-        "ec_value": ec_value,
-        "brightness": brightness,
-        "control_enabled": controller.control_enabled
-    }
-    return jsonify(status)
+@app.route("/api/events", methods=["GET"])
+def events_api():
+    """
+    ジャーナルのイベントを古い順に返す。since（通し番号）より後のイベントを limit 件まで返し、
+    続きは応答の next を since に指定して取得します。type はカンマ区切りで種類を絞り込みます。
+    """
+    since = request.args.get("since", 0, type=int)
+    limit = min(max(request.args.get("limit", 100, type=int), 1), 1000)
+    types = request.args.get("type")
+    return jsonify(journal.query(since, set(types.split(",")) if types else None, limit))
+
+@app.route("/api/stream", methods=["GET"])
+def stream_api():
+    """
+    状態・出力切り替え・センサー値をSSEで配信します。
+    接続直後に現在の状態を1回送り、その後は共有バッファの新しいイベントを送り続けます。
+    """
+    if isinstance(backend, RemoteBackend):
+        backend.start_poller()  # このプロセスで最初の接続時に開始
+    # 接続直後の status で最新の状態に揃えるため、知らないIDの場合は現在のIDから続ける
+    last_id = broker.resume_id(request.headers.get("Last-Event-ID"))
+    initial = f"event: status\ndata: {json.dumps(backend.status())}\n\n".encode("utf-8")
+
+    def generate(last_id):
+        yield initial
+        while True:
+            events = broker.wait(last_id, STREAM_KEEPALIVE)
+            if not events:
+                yield b": keepalive\n\n"
+                continue
+            last_id = events[-1][0]
+            yield b"".join(payload for event_id, payload in events)
+
+    return Response(generate(last_id), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+@app.errorhandler(DaemonUnavailable)
+def daemon_unavailable(e):
+    return jsonify({"status": "error", "message": str(e)}), 503
+
+def create_web_app():
+    """
+    制御デーモンとは別プロセスで動かすWebアプリを返す。ハードウェアには触れません。
+    例: gunicorn -w 4 -k gthread --threads 8 'app:create_web_app()'
+    """
+    global backend
+    if logger is None:
+        setup_logger(to_journal=False)
+    backend = RemoteBackend(SharedState(STATE_FILE, OUTPUT_CHANNELS, SensorSampler.FIELDS), CONTROL_SOCKET)
+    try:
+        history.open(readonly=True)
+    except (OSError, ValueError) as e:
+        logger.warning("History is not available: %s", e)
+    return app
+
+def start_hardware():
+    """コントローラーとセンサーの読み取りを開始する（on / daemon モード）"""
+    controller.setup()  # 前回のチェックポイントを読み込んでから書き込みを始める
+    controller.checkpoint.start()
+    set_temperature_resolution()
+    initial_settings = load_settings()
+    if initial_settings.get("control_enabled", True):
+        controller.start(initial_settings)
+    else:
+        controller.stop()
+    history.open()
+    sampler.start()
+
+def create_control_server():
+    """
+    制御ソケットを作る。別のプロセスが動作中の場合（二重起動）はメッセージを出して終了します。
+    ジャーナルやハードウェアに触れる前に呼びます。
+    """
+    try:
+        return ControlServer(CONTROL_SOCKET, backend.handle)
+    except OSError as e:
+        print(f"Cannot start: {e}", file=sys.stderr)
+        sys.exit(1)
+
+def start_control_server(server):
+    """制御ソケット（control.py のコマンド）の受け付けを開始する"""
+    server.start()
+    logger.info("Control socket listening on %s", CONTROL_SOCKET)
+
+def run_daemon(server):
+    """Webサーバーを持たない制御デーモン。状態を共有メモリに公開し、制御ソケットでコマンドを受け付ける"""
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    start_control_server(server)
+    start_hardware()
+    publisher = StatePublisher(SharedState(STATE_FILE, OUTPUT_CHANNELS, SensorSampler.FIELDS))
+    publisher.start()
+    logger.info("Control daemon started.")
+    try:
+        stop_event.wait()
+    finally:
+        publisher.stop()
+
+def run_web(port=5000, workers=WEB_WORKERS):
+    """
+    Webフロントエンドを複数のワーカープロセスで動かす。
+    待ち受けソケットを作ってから fork し、全ワーカーで同じソケットから接続を受け付けます。
+    """
+    from werkzeug.serving import make_server
+    create_web_app()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("0.0.0.0", port))
+    listener.listen(128)
+    children = []
+    for i in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            make_server("0.0.0.0", port, app, threaded=True, fd=listener.fileno()).serve_forever()
+            os._exit(0)
+        children.append(pid)
+    logger.info("Web frontend started on http://%s:%d/ with %d workers.", server_address.get(), port, workers)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        listener.close()
 
 if __name__ == "__main__":
-    setup_logger()
+    mode = sys.argv[1] if len(sys.argv) > 1 else None
+    server = None
+    if mode in ("on", "daemon"):
+        # 二重起動の確認はジャーナルを開く前に行う（ジャーナルの復旧は最後のセグメントを切り詰めるため）
+        server = create_control_server()
+    # ジャーナルに書き込むのはハードウェアを扱うプロセスだけ
+    setup_logger(to_journal=LOG_TO_FILE and server is not None)
+    if mode == "off":
+        # 動作中のアプリに制御ソケットで停止を依頼する（ハードウェアは初期化しない）
+        try:
+            control.call("stop")
+            logger.info("Stop requested via control socket.")
+        except DaemonUnavailable as e:
+            logger.info("Nothing to stop: %s", e)
+        sys.exit(0)
+    if mode == "web":
+        # ハードウェアを扱わないため、終了時の後始末も不要
+        try:
+            run_web(workers=int(sys.argv[2]) if len(sys.argv) > 2 else WEB_WORKERS)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
     try:
-        if len(sys.argv) > 1 and sys.argv[1] == 'on':
-            initial_settings = load_settings()
-            if initial_settings.get("control_enabled", True):
-                controller.start(initial_settings)
-            else:
-                controller.stop()
-            logger.info("Application started. Running Flask app on port 5000.")
-            app.run(host="0.0.0.0", port=5000)
+        if mode == 'on':
+            port = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            start_control_server(server)
+            start_hardware()
+            logger.info("Application started. Running Flask app on http://%s:%d/", server_address.get(), port)
+            app.run(host="0.0.0.0", port=port)
+        elif mode == "daemon":
+            run_daemon(server)
     except KeyboardInterrupt:
         logger.info("KeyboardInterrupt received. Shutting down...")
     finally:
-        update_led("none")
-        controller.stop()
-        GPIO.cleanup()
-        logger.info("GPIO cleaned up")
+        if server is not None:
+            server.stop()
+        if controller.hardware_ready:
+            sampler.stop()
+            history.close()
+            controller.stop()
+            controller.checkpoint.stop()
+            controller.led.close()
+            GPIO.cleanup()
+            logger.info("GPIO cleaned up")
         bus.close()
-
+        journal.stop()
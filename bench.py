@@ -0,0 +1,288 @@
+"""
+app.py の負荷試験。mock_rpi のエミュレーターモードでアプリを別プロセスとして起動し、
+以下を計測して JSON ファイルに出力します。
+
+- /api/status, /api/settings (GET/POST), / の同時接続数ごとのレイテンシ (p50/p95/p99) とスループット
+- Controller の出力切り替えの予定時刻と実際の時刻の差（ジッター）
+- リクエストあたりのサーバーCPU時間とメモリ使用量 (RSS)
+
+使い方:
+    python bench.py
+    python bench.py --concurrency 1,10,50 --duration 5 --output bench_results.json
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+DEFAULT_CONCURRENCY = (1, 5, 10, 25, 50)
+DEFAULT_DURATION = 3.0  # 1条件あたりの計測時間（秒）
+DEFAULT_OUTPUT = "bench_results.json"
+
+# ジッター計測用の設定（秒単位で切り替わるスケジュール）。動作時間帯は bench_settings で決めます
+BENCH_SETTINGS = {
+    "interval_output2_on": 0.05,  # 3秒
+    "interval_output3_on": 0.05,
+    "interval_both_off": 0.05,
+    "night_cycle_times": [],
+    "control_enabled": True,
+}
+# 動作時間帯の長さ。1日のサイクル数の上限（app.MAX_DAY_CYCLES）に収まるようにする
+BENCH_WINDOW = timedelta(hours=2)
+
+
+def bench_settings(now):
+    """現在時刻から BENCH_WINDOW の間（日付をまたぐ場合は23:59まで）を動作時間帯にした設定"""
+    start = now.replace(second=0, microsecond=0)
+    end = min(start + BENCH_WINDOW, start.replace(hour=23, minute=59))
+    return dict(BENCH_SETTINGS, start_time=f"{start:%H:%M}", end_time=f"{end:%H:%M}")
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[index]
+
+
+def process_usage(pid):
+    """プロセスのCPU時間（秒）とRSS（KB）を /proc から読む"""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    ticks = os.sysconf("SC_CLK_TCK")
+    cpu = (int(fields[11]) + int(fields[12])) / ticks  # utime + stime
+    rss = None
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1])
+    return cpu, rss
+
+
+# ---- サーバー側（子プロセス） ----
+
+def measure_jitter(schedule, trace, started, finished, channels):
+    """予定された遷移ごとに、最初のピンが実際に切り替わった時刻との差（ミリ秒）を求める"""
+    pin_events = {}
+    for at, pin, state in trace:
+        pin_events.setdefault(pin, []).append((at, state))
+
+    jitter = []
+    previous = None
+    day = started.date() - timedelta(days=1)
+    while day <= finished.date():
+        for transition in schedule.transitions(day):
+            if previous is not None and started < transition.at < finished:
+                for channel, on in transition.outputs.items():
+                    if previous.outputs.get(channel) == on:
+                        continue
+                    pin = channels[channel][0]
+                    actual = next((at for at, state in pin_events.get(pin, [])
+                                   if state == int(on) and at >= transition.at - timedelta(seconds=1)), None)
+                    if actual is not None:
+                        jitter.append((actual - transition.at).total_seconds() * 1000)
+            previous = transition
+        day += timedelta(days=1)
+    return jitter
+
+
+def serve(port, result_path, bench):
+    os.environ.setdefault("MOCK_RPI_MODE", "emulator")
+    workdir = tempfile.mkdtemp(prefix="cycle_switch_bench_")
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, os.getcwd())
+    import app
+    import RPi.GPIO as GPIO
+    from werkzeug.serving import make_server
+
+    app.journal.directory = os.path.join(workdir, "journal")
+    app.setup_logger()
+    app.settings_store.path = os.path.join(workdir, "settings.json")
+    app.history.path = os.path.join(workdir, "history.bin")
+    app.controller.checkpoint.path = os.path.join(workdir, "checkpoint.bin")
+    app.history.open()
+    app.sampler.start()
+
+    settings = app.normalize_settings(bench)
+    app.settings_store.save(settings)
+    if hasattr(GPIO, "start_trace"):
+        GPIO.start_trace(datetime.now)
+    started = datetime.now()
+    app.controller.start(settings)
+
+    server = make_server("127.0.0.1", port, app.app, threaded=True)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("READY", flush=True)
+    stop.wait()
+
+    finished = datetime.now()
+    schedule = app.controller.schedule
+    app.controller.stop()
+    trace = GPIO.stop_trace() if hasattr(GPIO, "stop_trace") else []
+    jitter = measure_jitter(schedule, trace, started, finished, app.OUTPUT_CHANNELS)
+    with open(result_path, "w") as f:
+        json.dump({"jitter_ms": jitter}, f)
+    server.shutdown()
+
+
+# ---- クライアント側 ----
+
+def run_load(port, method, path, body, concurrency, duration):
+    """duration 秒間、concurrency 本の接続でリクエストを送り続け、レイテンシを集める"""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+    headers = {"Content-Type": "application/json"} if body is not None else {}
+
+    def client():
+        local = []
+        failed = 0
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                conn.close()
+                if response.status >= 400:
+                    failed += 1
+                    continue
+            except OSError:
+                failed += 1
+                continue
+            local.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client) for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0], time.perf_counter() - started
+
+
+def summarize(latencies, errors, elapsed):
+    ms = [latency * 1000 for latency in latencies]
+    return {
+        "requests": len(ms),
+        "errors": errors,
+        "throughput_rps": round(len(ms) / elapsed, 2) if elapsed else None,
+        "p50_ms": percentile(ms, 50),
+        "p95_ms": percentile(ms, 95),
+        "p99_ms": percentile(ms, 99),
+        "mean_ms": sum(ms) / len(ms) if ms else None,
+        "max_ms": max(ms) if ms else None,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="app.py の負荷試験")
+    parser.add_argument("--concurrency", default=",".join(map(str, DEFAULT_CONCURRENCY)),
+                        help="同時接続数（カンマ区切り）")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION, help="1条件あたりの計測時間（秒）")
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="結果のJSONファイル")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    parser.add_argument("--settings", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        serve(args.port, args.result, json.loads(args.settings))
+        return 0
+
+    result_file = tempfile.NamedTemporaryFile(suffix=".json", delete=False).name
+    # サーバーと POST /api/settings で同じ設定を使い、計測中にスケジュールが変わらないようにする
+    body = json.dumps(bench_settings(datetime.now()))
+    server = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve", "--port", str(args.port), "--result", result_file,
+         "--settings", body],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    if server.stdout.readline().strip() != "READY":
+        server.kill()
+        raise RuntimeError("benchmark server failed to start")
+
+    endpoints = [
+        ("GET", "/api/status", None),
+        ("GET", "/api/settings", None),
+        ("POST", "/api/settings", body),
+        ("GET", "/", None),
+    ]
+    results = []
+    try:
+        for method, path, payload in endpoints:
+            for concurrency in [int(c) for c in args.concurrency.split(",")]:
+                cpu_before, rss_before = process_usage(server.pid)
+                latencies, errors, elapsed = run_load(args.port, method, path, payload, concurrency, args.duration)
+                cpu_after, rss_after = process_usage(server.pid)
+                summary = summarize(latencies, errors, elapsed)
+                summary.update({
+                    "method": method,
+                    "path": path,
+                    "concurrency": concurrency,
+                    "server_cpu_ms_per_request": (
+                        round((cpu_after - cpu_before) * 1000 / summary["requests"], 3)
+                        if summary["requests"] else None),
+                    "server_rss_kb": rss_after,
+                    "server_rss_delta_kb": rss_after - rss_before,
+                })
+                results.append(summary)
+                print(f"{method:4} {path:15} c={concurrency:<3} {summary['throughput_rps']:>8} req/s "
+                      f"p50={summary['p50_ms'] or 0:.1f}ms p95={summary['p95_ms'] or 0:.1f}ms "
+                      f"p99={summary['p99_ms'] or 0:.1f}ms errors={errors}")
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=30)
+
+    with open(result_file) as f:
+        jitter = json.load(f)["jitter_ms"]
+    os.unlink(result_file)
+    abs_jitter = [abs(j) for j in jitter]
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "duration": args.duration,
+        "requests": results,
+        "scheduler_jitter": {
+            "transitions": len(jitter),
+            "p50_ms": percentile(abs_jitter, 50),
+            "p95_ms": percentile(abs_jitter, 95),
+            "p99_ms": percentile(abs_jitter, 99),
+            "max_ms": max(abs_jitter) if abs_jitter else None,
+            "mean_ms": sum(jitter) / len(jitter) if jitter else None,
+        },
+    }
+    print(f"scheduler jitter: {report['scheduler_jitter']}")
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
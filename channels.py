@@ -0,0 +1,130 @@
+"""
+出力チャンネルの定義。
+チャンネルごとに、同時に切り替えるGPIOピンの組と、チャンネルを動かすスケジュールを指定します。
+
+    {
+        "channels": {
+            "air":   {"pins": [6], "schedule": {"cycle": "air"}},
+            "left":  {"pins": [20, 26], "schedule": {"cycle": "left"}, "water": true},
+            "right": {"pins": [16, 19], "schedule": {"cycle": "right"}, "water": true},
+            "light": {"pins": [13], "schedule": {"daily": [["06:00", "20:00"]]}}
+        },
+        "exclusive": [["left", "right"]]
+    }
+
+schedule:
+    {"cycle": 役割}  設定画面の動作サイクルに従う（役割は air / left / right。同じ役割を複数のチャンネルに指定できる）
+    {"daily": [[ON時刻, OFF時刻], ...]}  毎日の時間帯だけON（OFF時刻がON時刻より前なら翌日まで）
+    null  常にOFF
+water: 水位低下時に止めるチャンネル
+exclusive: 同時にONにしないチャンネルの組
+"""
+import json
+from datetime import datetime, timedelta
+
+CYCLE_ROLES = ("air", "left", "right")
+MAX_CHANNELS = 32  # 共有状態ブロックの出力ビット数
+
+
+class ChannelConfigError(ValueError):
+    """チャンネル定義が正しくない"""
+
+
+def parse_time(value):
+    """"HH:MM" または "HH:MM:SS" 形式の時刻を読み取る"""
+    for fmt in ("%H:%M:%S", "%H:%M"):
+        try:
+            return datetime.strptime(value, fmt).time()
+        except (TypeError, ValueError):
+            pass
+    raise ChannelConfigError(f"Invalid time: {value}")
+
+
+class ChannelConfig:
+    """
+    検証済みのチャンネル定義。
+    pins: チャンネル -> ピンの組, cycle: 役割 -> チャンネルの組, daily: チャンネル -> [(ON時刻, OFF時刻)],
+    water: 水位低下時に止めるチャンネル, exclusive: 同時にONにしないチャンネルの組
+    """
+    def __init__(self, config):
+        channels = config.get("channels")
+        if not channels:
+            raise ChannelConfigError("No channels defined")
+        if len(channels) > MAX_CHANNELS:
+            raise ChannelConfigError(f"Too many channels (max {MAX_CHANNELS})")
+        self.pins = {}
+        self.cycle = {role: () for role in CYCLE_ROLES}
+        self.daily = {}
+        used = {}
+        for name, channel in channels.items():
+            pins = tuple(channel.get("pins", ()))
+            if not pins or not all(isinstance(pin, int) for pin in pins):
+                raise ChannelConfigError(f"Channel {name}: pins must be a non-empty list of GPIO numbers")
+            for pin in pins:
+                if pin in used:
+                    raise ChannelConfigError(f"Channel {name}: pin {pin} is already used by {used[pin]}")
+                used[pin] = name
+            self.pins[name] = pins
+            schedule = channel.get("schedule")
+            if schedule is None:
+                continue
+            if "cycle" in schedule:
+                role = schedule["cycle"]
+                if role not in CYCLE_ROLES:
+                    raise ChannelConfigError(f"Channel {name}: unknown cycle role {role}")
+                self.cycle[role] += (name,)
+            elif "daily" in schedule:
+                self.daily[name] = [(parse_time(on), parse_time(off)) for on, off in schedule["daily"]]
+            else:
+                raise ChannelConfigError(f"Channel {name}: unknown schedule {schedule}")
+        self.water = tuple(name for name, channel in channels.items() if channel.get("water"))
+        self.exclusive = [tuple(group) for group in config.get("exclusive", [])]
+        for group in self.exclusive:
+            unknown = [name for name in group if name not in self.pins]
+            if unknown:
+                raise ChannelConfigError(f"Unknown channels in exclusive group: {', '.join(unknown)}")
+
+    @classmethod
+    def load(cls, path, default):
+        """path のJSONファイルを読み込む（ファイルがなければ default を使う）"""
+        try:
+            with open(path) as f:
+                config = json.load(f)
+        except FileNotFoundError:
+            config = default
+        return cls(config)
+
+    def cycle_outputs(self, air=False, left=False, right=False):
+        """動作サイクルの役割ごとの出力を、チャンネルごとの出力にする"""
+        flags = {"air": air, "left": left, "right": right}
+        return {name: flags[role] for role, names in self.cycle.items() for name in names}
+
+    def resolve(self, outputs, current):
+        """
+        同時にONにしないチャンネルの組で複数がONになる場合、現在ONのもの（なければ組の先頭）だけを残す。
+        (調整後の出力, OFFにしたチャンネル) を返します。
+        """
+        outputs = dict(outputs)
+        blocked = []
+        for group in self.exclusive:
+            on = [name for name in group if outputs.get(name)]
+            if len(on) < 2:
+                continue
+            keep = next((name for name in on if current.get(name)), on[0])
+            for name in on:
+                if name != keep:
+                    outputs[name] = False
+                    blocked.append(name)
+        return outputs, blocked
+
+
+def daily_windows(windows, day):
+    """指定日に始まる時間帯の (ON時刻, OFF時刻) の一覧"""
+    result = []
+    for on_time, off_time in windows:
+        on_at = datetime.combine(day, on_time)
+        off_at = datetime.combine(day, off_time)
+        if off_at <= on_at:
+            off_at += timedelta(days=1)
+        result.append((on_at, off_at))
+    return result
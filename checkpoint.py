@@ -0,0 +1,105 @@
+import json
+import os
+import struct
+import threading
+import zlib
+
+SLOT_SIZE = 1024  # 1スロットの大きさ（バイト）。ファイルは2スロット分
+
+MAGIC = b"CSCKPT01"
+HEADER = struct.Struct("<8sQII")  # マジック, 通し番号, CRC32, 内容の長さ
+
+# fdatasync がない環境では fsync を使う
+sync = getattr(os, "fdatasync", os.fsync)
+
+
+class Checkpoint:
+    """
+    コントローラーの状態（フェーズ・次の切り替え時刻・出力）のチェックポイント。
+    2つのスロット（A/B）に交互に書き込むため、書き込み途中で電源が切れても
+    もう一方のスロットに直前の状態が残ります（CRCで書きかけのスロットを判別します）。
+    save() は最新の状態を預けるだけで戻り、書き込み（fdatasync まで）は専用のスレッドが行います。
+    書き込みが追いつかない場合は、途中の状態を飛ばして最新の状態だけを書きます。
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.seq = 0
+        self.pending = None
+        self.stopping = False
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.thread = None
+        self.writes = 0
+        self.errors = 0
+
+    def load(self):
+        """有効なスロットのうち新しい方の状態を返す（なければ None）"""
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read(2 * SLOT_SIZE)
+        except FileNotFoundError:
+            return None
+        best = None
+        for offset in (0, SLOT_SIZE):
+            slot = data[offset:offset + SLOT_SIZE]
+            if len(slot) < HEADER.size:
+                continue
+            magic, seq, crc, length = HEADER.unpack_from(slot)
+            payload = slot[HEADER.size:HEADER.size + length]
+            if magic != MAGIC or len(payload) != length or zlib.crc32(payload) != crc:
+                continue  # 書きかけ、または未使用のスロット
+            if best is None or seq > best[0]:
+                best = (seq, payload)
+        if best is None:
+            return None
+        self.seq = max(self.seq, best[0])
+        return json.loads(best[1])
+
+    def start(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.load()  # 通し番号を引き継ぐ
+        self.stopping = False
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """書き込み待ちの状態を書いてから終了する"""
+        if self.thread is None:
+            return
+        self.stopping = True
+        self.event.set()
+        self.thread.join(timeout=5)
+        self.thread = None
+        os.close(self.fd)
+        self.fd = None
+
+    def save(self, state):
+        """状態を書き込み待ちにする（ブロックしない）"""
+        with self.lock:
+            self.pending = state
+        self.event.set()
+
+    def writer(self):
+        while True:
+            self.event.wait()
+            self.event.clear()
+            with self.lock:
+                state, self.pending = self.pending, None
+            if state is not None:
+                try:
+                    self.write(state)
+                    self.writes += 1
+                except (OSError, ValueError, TypeError):
+                    self.errors += 1
+            if self.stopping:
+                return
+
+    def write(self, state):
+        payload = json.dumps(state, separators=(",", ":")).encode("utf-8")
+        if HEADER.size + len(payload) > SLOT_SIZE:
+            raise ValueError("Checkpoint state is too large")
+        self.seq += 1
+        data = HEADER.pack(MAGIC, self.seq, zlib.crc32(payload), len(payload)) + payload
+        os.pwrite(self.fd, data.ljust(SLOT_SIZE, b"\0"), (self.seq % 2) * SLOT_SIZE)
+        sync(self.fd)
@@ -0,0 +1,181 @@
+"""
+制御ソケット（Unixドメインソケット）のサーバー・クライアントと、コマンドラインツール。
+ハードウェアのライブラリや app.py を import しないため、すぐに起動・終了します。
+
+使い方:
+    python control.py status
+    python control.py stop
+    python control.py start
+    python control.py apply-settings settings.json
+    python control.py next-transitions --count 5
+"""
+import argparse
+import errno
+import json
+import os
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+
+CONTROL_SOCKET = os.path.join(tempfile.gettempdir(), "cycle_switch.sock")
+CONTROL_TIMEOUT = 10  # 応答待ち（秒）
+
+
+class DaemonUnavailable(Exception):
+    """制御ソケットに接続できない（アプリが動作していない）"""
+
+
+class CommandError(Exception):
+    """
+    コマンドの実行に失敗した。
+    code は失敗の種類（"invalid": 引数が正しくない, "conflict": 前提条件が一致しない, None: それ以外）
+    """
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+def call(command, path=CONTROL_SOCKET, timeout=CONTROL_TIMEOUT, **args):
+    """制御ソケットにコマンドを1つ送り、結果を返す"""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(timeout)
+            s.connect(path)
+            s.sendall(json.dumps({"command": command, "args": args}).encode("utf-8") + b"\n")
+            with s.makefile("rb") as f:
+                line = f.readline()
+    except OSError as e:
+        raise DaemonUnavailable(f"Control socket is not available: {e}")
+    if not line:
+        raise DaemonUnavailable("Control socket closed the connection")
+    response = json.loads(line)
+    if response.get("status") != "success":
+        raise CommandError(response.get("message", "Control command failed"), response.get("code"))
+    return response["result"]
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """1行1コマンドのJSONを受け取り、1行のJSONで応答する"""
+    def handle(self):
+        for line in self.rfile:
+            try:
+                command = json.loads(line)
+            except ValueError:
+                response = {"status": "error", "message": "Invalid JSON"}
+            else:
+                response = self.server.handler(command)
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    ローカルの制御コマンドを受け付けるサーバー。
+    handler はコマンド {"command": 名前, "args": {...}} を受け取り、応答の辞書を返す関数です。
+    """
+    daemon_threads = True
+
+    def __init__(self, path, handler):
+        if os.path.exists(path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                if s.connect_ex(path) == 0:
+                    raise OSError(errno.EADDRINUSE, "Control socket is in use by another process", path)
+            os.unlink(path)  # 前回の異常終了で残ったソケット
+        super().__init__(path, ControlHandler)
+        os.chmod(path, 0o660)
+        self.path = path
+        self.handler = handler
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.shutdown()  # serve_forever を始めていない場合は待たない
+            self.thread = None
+        self.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def print_status(status):
+    print(f"operation: {status['operation']} ({status['phase']})")
+    print(f"control:   {'enabled' if status['control_enabled'] else 'disabled'}")
+    print(f"water:     {status['water_level']}")
+    for field, sample in status.get("samples", {}).items():
+        value = status.get(field)
+        age = sample.get("age")
+        print(f"{field + ':':<12}{'--' if value is None else value} "
+              f"[{sample.get('status')}{'' if age is None else f', {age:.0f} s ago'}]")
+
+
+def print_transitions(transitions):
+    for transition in transitions:
+        if transition["phase"] == "timer":
+            outputs = " ".join(transition["outputs"])  # 時間帯で動くチャンネル（ON/OFFは state の列）
+        else:
+            outputs = " ".join(channel for channel, on in transition["outputs"].items() if on) or "-"
+        print(f"{transition['time']}  {transition['phase']:<6} {transition['state']:<8} {outputs}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="cycle_switch の制御コマンド")
+    parser.add_argument("--socket", default=CONTROL_SOCKET, help="制御ソケットのパス")
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力する")
+    commands = parser.add_subparsers(dest="command", required=True)
+    status = commands.add_parser("status", help="動作状態とセンサー値を表示する")
+    status.add_argument("--refresh", action="store_true", help="センサーをその場で読み取る")
+    commands.add_parser("stop", help="制御を停止する（出力はすべてOFF）")
+    commands.add_parser("start", help="保存されている設定で制御を開始する")
+    apply = commands.add_parser("apply-settings", help="設定を保存して反映する")
+    apply.add_argument("file", help="設定のJSONファイル（- は標準入力）")
+    transitions = commands.add_parser("next-transitions", help="今後の出力切り替えを表示する")
+    transitions.add_argument("--count", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "status":
+            result = call("status", args.socket, refresh=args.refresh)
+        elif args.command == "stop":
+            result = call("stop", args.socket)
+        elif args.command == "start":
+            result = call("start", args.socket)
+        elif args.command == "apply-settings":
+            if args.file == "-":
+                settings = json.load(sys.stdin)
+            else:
+                with open(args.file) as f:
+                    settings = json.load(f)
+            result = call("save_settings", args.socket, settings=settings)
+        else:
+            result = call("transitions", args.socket, count=args.count)
+    except DaemonUnavailable as e:
+        if args.command == "stop":
+            # 動作していなければ止めるものはない（systemctl stop を失敗扱いにしない）
+            print(f"nothing to stop: {e}")
+            return 0
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    except CommandError as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+
+    if args.json:
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+    elif args.command == "status":
+        print_status(result)
+    elif args.command == "next-transitions":
+        print_transitions(result)
+    elif args.command == "start" and not result:
+        print("control is disabled in the saved settings")
+    elif args.command == "apply-settings":
+        print(f"settings applied (etag {result})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
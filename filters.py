@@ -0,0 +1,190 @@
+import bisect
+import math
+from collections import deque
+
+# 中央絶対偏差（MAD）を標準偏差に換算する係数（正規分布の場合）
+MAD_SCALE = 1.4826
+
+
+class RollingWindow:
+    """直近 size 件の値を、到着順と昇順の両方で保持する（中央値を求めるため）"""
+    def __init__(self, size):
+        self.values = deque(maxlen=size)
+        self.sorted = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, value):
+        if len(self.values) == self.values.maxlen:
+            del self.sorted[bisect.bisect_left(self.sorted, self.values[0])]
+        self.values.append(value)
+        bisect.insort(self.sorted, value)
+
+    def clear(self):
+        self.values.clear()
+        self.sorted = []
+
+    def median(self):
+        n = len(self.sorted)
+        middle = n // 2
+        return self.sorted[middle] if n % 2 else (self.sorted[middle - 1] + self.sorted[middle]) / 2
+
+
+class EmaFilter:
+    """指数移動平均"""
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, value):
+        self.value = value if self.value is None else self.value + self.alpha * (value - self.value)
+        return self.value
+
+    def reset(self):
+        self.value = None
+
+
+class MedianFilter:
+    """直近 window 件の中央値"""
+    def __init__(self, window):
+        self.window = RollingWindow(window)
+
+    def update(self, value):
+        self.window.add(value)
+        return self.window.median()
+
+    def reset(self):
+        self.window.clear()
+
+
+class KalmanFilter:
+    """
+    1次元カルマンフィルター（値は一定で、ゆっくり変化するモデル）。
+    process_variance: 1サンプルあたりの真値の変化の分散, measurement_variance: 測定値の分散
+    """
+    def __init__(self, process_variance, measurement_variance):
+        self.process_variance = process_variance
+        self.measurement_variance = measurement_variance
+        self.value = None
+        self.variance = None
+
+    def update(self, value):
+        if self.value is None:
+            self.value = value
+            self.variance = self.measurement_variance
+            return value
+        variance = self.variance + self.process_variance
+        gain = variance / (variance + self.measurement_variance)
+        self.value += gain * (value - self.value)
+        self.variance = (1 - gain) * variance
+        return self.value
+
+    def reset(self):
+        self.value = None
+        self.variance = None
+
+
+FILTERS = {
+    "ema": EmaFilter,
+    "median": MedianFilter,
+    "kalman": KalmanFilter,
+}
+
+
+class SpikeRejector:
+    """
+    ロバストzスコア（直近の値の中央値とMADによる）で外れ値を除外する。
+    MADが min_scale より小さい場合は min_scale を使います（分解能の粗いセンサーで同じ値が続いた場合）。
+    max_rejects 回続けて除外した場合は、値が実際に変化したとみなして受け入れ直します。
+    """
+    def __init__(self, threshold, min_scale, window=15, max_rejects=3):
+        self.threshold = threshold
+        self.min_scale = min_scale
+        self.window = RollingWindow(window)
+        self.deviations = RollingWindow(window)
+        self.max_rejects = max_rejects
+        self.rejects = 0
+
+    def accept(self, value):
+        """値を受け入れる場合は True"""
+        if len(self.window) >= 5:
+            median = self.window.median()
+            scale = max(self.deviations.median() * MAD_SCALE, self.min_scale)
+            if abs(value - median) / scale > self.threshold:
+                self.rejects += 1
+                if self.rejects < self.max_rejects:
+                    return False
+                self.reset()  # 段階的な変化：基準を作り直す
+        self.rejects = 0
+        median = self.window.median() if len(self.window) else value
+        self.window.add(value)
+        self.deviations.add(abs(value - median))
+        return True
+
+    def reset(self):
+        self.window.clear()
+        self.deviations.clear()
+        self.rejects = 0
+
+
+class SignalFilter:
+    """
+    1項目分のフィルター（外れ値の除外 → 平滑化 → 欠測の補完）。1サンプルあたりの処理量は一定です。
+    config: {"filter": (種類, 引数...), "spike": (しきい値, 最小スケール), "max_gap": 秒}
+    """
+    def __init__(self, config):
+        kind, *args = config.get("filter", ("ema", 1.0))
+        self.filter = FILTERS[kind](*args)
+        spike = config.get("spike")
+        self.spike = SpikeRejector(*spike) if spike else None
+        self.max_gap = config.get("max_gap", 0)
+        self.value = None
+        self.timestamp = None
+
+    def update(self, value, timestamp):
+        """測定値を処理し、(フィルター後の値, 状態) を返す。状態は "ok" または "rejected"（直前の値を返す）"""
+        if isinstance(value, float) and math.isnan(value):
+            return self.value, "rejected"
+        if self.timestamp is not None and timestamp - self.timestamp > self.max_gap:
+            # 長く途切れた後は過去の値に引きずられないようにやり直す
+            self.filter.reset()
+            if self.spike:
+                self.spike.reset()
+        if self.spike and not self.spike.accept(value):
+            return self.value, "rejected"
+        self.value = self.filter.update(value)
+        self.timestamp = timestamp
+        return self.value, "ok"
+
+    def fill(self, timestamp):
+        """読み取りに失敗したとき、直前の値が max_gap 秒以内なら補完値として返す（それ以外は None）"""
+        if self.timestamp is None or timestamp - self.timestamp > self.max_gap:
+            return None
+        return self.value
+
+
+class FilterPipeline:
+    """項目ごとの SignalFilter をまとめたもの。設定のない項目はそのまま通します"""
+    def __init__(self, configs):
+        self.filters = {field: SignalFilter(config) for field, config in configs.items()}
+
+    def update(self, values, timestamp):
+        """測定値の辞書を処理し、(フィルター後の値, 除外した項目) を返す"""
+        filtered = {}
+        rejected = []
+        for field, value in values.items():
+            signal = self.filters.get(field)
+            if signal is None or value is None:
+                filtered[field] = value
+                continue
+            value, status = signal.update(value, timestamp)
+            if status == "rejected":
+                rejected.append(field)
+            else:
+                filtered[field] = value
+        return filtered, rejected
+
+    def fill(self, field, timestamp):
+        signal = self.filters.get(field)
+        return None if signal is None else signal.fill(timestamp)
@@ -0,0 +1,426 @@
+"""
+複数の cycle_switch ノードをまとめて監視・設定するアグリゲーター。
+asyncio で全ノードの /api/status と /api/settings を並行して取得し、最新の状態を保持します。
+ノードごとに持続的な接続（keep-alive）を使い回し、応答しないノードは間隔を延ばして再試行します。
+まとめた状態は1つのHTTPサーバーで返し、設定はグループ単位で並行して送ります。
+外部ライブラリや app.py には依存しません。
+
+設定ファイル（JSON）:
+    {"nodes": [{"name": "bed1", "url": "http://192.168.0.11:5000", "groups": ["greenhouse"]}, ...]}
+
+使い方:
+    python fleet.py fleet.json --port 5100
+    curl http://localhost:5100/api/fleet
+    curl -X POST -d @settings.json "http://localhost:5100/api/fleet/settings?group=greenhouse"
+
+手元で試す場合は、ノードごとに別のディレクトリで TMPDIR を分けて app.py を起動します
+（制御ソケットは TMPDIR に作られます）:
+    (cd node1 && TMPDIR=$PWD python app.py on 5001)
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import sys
+import time
+import urllib.parse
+
+POLL_INTERVAL = 5.0    # 状態を取得する間隔（秒）
+REQUEST_TIMEOUT = 3.0  # 1回の要求の待ち時間（秒）
+BACKOFF_FACTOR = 2.0   # 失敗が続くたびに取得間隔を延ばす倍率
+BACKOFF_MAX = 120.0    # 失敗時の取得間隔の上限（秒）
+POLL_JITTER = 0.1      # 取得時刻を分散させる割合（全ノードに同時に要求しない）
+POOL_SIZE = 2          # ノードごとの最大同時接続数
+STALE_INTERVALS = 3    # 最後の取得から取得間隔のこの倍数を過ぎた状態は古いとみなす
+MAX_BODY = 1024 * 1024  # 受け付ける要求本文の上限（バイト）
+
+FETCH_ERRORS = (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError)
+
+logger = logging.getLogger("fleet")
+
+
+class HttpError(Exception):
+    """ノードがエラー応答を返した"""
+    def __init__(self, status, message):
+        super().__init__(f"HTTP {status}: {message}")
+        self.status = status
+
+
+async def read_head(reader):
+    """開始行とヘッダー（名前は小文字）を読む。接続が閉じられていれば (None, None)"""
+    line = await reader.readline()
+    if not line:
+        return None, None
+    headers = {}
+    while True:
+        header = await reader.readline()
+        if header in (b"\r\n", b"\n"):
+            break
+        if not header:
+            raise asyncio.IncompleteReadError(header, None)
+        name, _, value = header.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return line.decode("latin-1").rstrip("\r\n"), headers
+
+
+async def read_body(reader, headers):
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                await reader.readline()  # 最後の空行（トレーラーは使わない）
+                return b"".join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+    if "content-length" in headers:
+        return await reader.readexactly(int(headers["content-length"]))
+    return await reader.read()  # 接続が閉じるまで
+
+
+class HttpConnection:
+    """1本の持続的なHTTP/1.1接続"""
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    @property
+    def connected(self):
+        return self.writer is not None
+
+    async def request(self, method, path, body=None, headers=None):
+        """要求を送り (ステータス, ヘッダー, 本文) を返す"""
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}", "Connection: keep-alive"]
+        for name, value in (headers or {}).items():
+            lines.append(f"{name}: {value}")
+        if body is not None:
+            lines.append(f"Content-Length: {len(body)}")
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (body or b""))
+        await self.writer.drain()
+        status_line, response_headers = await read_head(self.reader)
+        if status_line is None:
+            raise ConnectionResetError("Connection closed by node")
+        status = int(status_line.split(" ", 2)[1])
+        if method == "HEAD" or status in (204, 304):
+            response_body = b""
+        else:
+            response_body = await read_body(self.reader, response_headers)
+        framed = "content-length" in response_headers or "transfer-encoding" in response_headers or not response_body
+        if response_headers.get("connection", "").lower() == "close" or not framed:
+            self.close()  # 本文を接続の終わりまで読んだ場合も使い回せない
+        return status, response_headers, response_body
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+
+class NodeClient:
+    """ノード1台分の接続プール"""
+    def __init__(self, url, size=POOL_SIZE):
+        parsed = urllib.parse.urlsplit(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.idle = []
+        self.semaphore = asyncio.Semaphore(size)
+
+    async def request(self, method, path, body=None, headers=None, timeout=REQUEST_TIMEOUT):
+        async with self.semaphore:
+            connection = self.idle.pop() if self.idle else HttpConnection(self.host, self.port)
+            reused = connection.connected
+            try:
+                try:
+                    result = await asyncio.wait_for(connection.request(method, path, body, headers), timeout)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    if not reused:
+                        raise
+                    # 使い回した接続がノード側で閉じられていた：新しい接続で1回だけやり直す
+                    connection.close()
+                    result = await asyncio.wait_for(connection.request(method, path, body, headers), timeout)
+            except BaseException:
+                connection.close()
+                raise
+            if connection.connected:
+                self.idle.append(connection)
+            return result
+
+    async def get_json(self, path, etag=None, timeout=REQUEST_TIMEOUT):
+        """JSONを取得し (内容, ETag) を返す。etag が一致して変更がなければ内容は None"""
+        headers = {"If-None-Match": f'"{etag}"'} if etag else None
+        status, response_headers, body = await self.request("GET", path, headers=headers, timeout=timeout)
+        if status == 304:
+            return None, etag
+        if status != 200:
+            raise HttpError(status, body[:200].decode("utf-8", "replace"))
+        return json.loads(body), response_headers.get("etag", "").strip('"') or None
+
+    async def post_json(self, path, data, timeout=REQUEST_TIMEOUT):
+        body = json.dumps(data).encode("utf-8")
+        status, response_headers, response_body = await self.request(
+            "POST", path, body, {"Content-Type": "application/json"}, timeout)
+        if status != 200:
+            raise HttpError(status, response_body[:200].decode("utf-8", "replace"))
+        return json.loads(response_body), response_headers.get("etag", "").strip('"') or None
+
+    def close(self):
+        for connection in self.idle:
+            connection.close()
+        self.idle = []
+
+
+class Node:
+    """監視対象のノードと、最後に取得した状態"""
+    def __init__(self, name, url, groups=()):
+        self.name = name
+        self.url = url
+        self.groups = set(groups)
+        self.client = NodeClient(url)
+        self.status = None
+        self.settings = None
+        self.settings_etag = None
+        self.updated = None   # 最後に取得に成功した時刻
+        self.latency = None
+        self.error = None
+        self.failures = 0
+        self.wake = asyncio.Event()  # 次の取得を待たずにすぐ取得し直す
+
+    async def poll(self, timeout):
+        started = time.monotonic()
+        (status, _), (settings, etag) = await asyncio.gather(
+            self.client.get_json("/api/status", timeout=timeout),
+            self.client.get_json("/api/settings", self.settings_etag, timeout=timeout))
+        if settings is not None:
+            self.settings = settings
+            self.settings_etag = etag
+        self.status = status
+        self.latency = time.monotonic() - started
+        self.updated = time.time()
+        if self.failures:
+            logger.info("Node %s is back online", self.name)
+        self.failures = 0
+        self.error = None
+
+    def failed(self, error):
+        if not self.failures:
+            logger.warning("Node %s is not responding: %s", self.name, error or type(error).__name__)
+        self.failures += 1
+        self.error = str(error) or type(error).__name__
+
+    def snapshot(self, now, stale):
+        age = None if self.updated is None else round(now - self.updated, 1)
+        return {
+            "url": self.url,
+            "groups": sorted(self.groups),
+            "online": self.failures == 0 and age is not None and age <= stale,
+            "age": age,
+            "latency": None if self.latency is None else round(self.latency, 3),
+            "failures": self.failures,
+            "error": self.error,
+            "settings_etag": self.settings_etag,
+            "status": self.status,
+        }
+
+
+class Fleet:
+    """全ノードの定期取得・まとめた状態・設定の一括送信"""
+    def __init__(self, nodes, interval=POLL_INTERVAL, timeout=REQUEST_TIMEOUT):
+        self.nodes = {node.name: node for node in nodes}
+        self.interval = interval
+        self.timeout = timeout
+        self.stale = STALE_INTERVALS * interval
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.poll_loop(node)) for node in self.nodes.values()]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        for node in self.nodes.values():
+            node.client.close()
+
+    async def poll_loop(self, node):
+        while True:
+            node.wake.clear()
+            try:
+                await node.poll(self.timeout)
+                delay = self.interval
+            except FETCH_ERRORS + (HttpError,) as e:
+                node.failed(e)
+                delay = min(BACKOFF_MAX, self.interval * BACKOFF_FACTOR ** node.failures)
+            delay *= random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+            try:
+                await asyncio.wait_for(node.wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def select(self, group=None, names=None):
+        """グループ名またはノード名の一覧に該当するノード（どちらもなければ全ノード）"""
+        nodes = self.nodes.values()
+        if group:
+            nodes = [node for node in nodes if group in node.groups]
+        if names:
+            unknown = set(names) - set(self.nodes)
+            if unknown:
+                raise KeyError(f"Unknown nodes: {', '.join(sorted(unknown))}")
+            nodes = [node for node in nodes if node.name in names]
+        return list(nodes)
+
+    async def push_settings(self, settings, nodes):
+        """設定を各ノードに並行して送り、ノードごとの結果を返す"""
+        async def push(node):
+            try:
+                _, etag = await node.client.post_json("/api/settings", settings, timeout=self.timeout)
+            except FETCH_ERRORS + (HttpError,) as e:
+                logger.warning("Failed to push settings to %s: %s", node.name, e)
+                return node.name, {"status": "error", "message": str(e) or type(e).__name__}
+            node.wake.set()  # 反映後の状態をすぐ取り直す
+            return node.name, {"status": "success", "etag": etag}
+        results = await asyncio.gather(*(push(node) for node in nodes))
+        logger.info("Settings pushed to %d nodes (%d failed)", len(results),
+                    sum(result["status"] != "success" for _, result in results))
+        return dict(results)
+
+    def status(self):
+        """全ノードの状態と集計"""
+        now = time.time()
+        nodes = {name: node.snapshot(now, self.stale) for name, node in self.nodes.items()}
+        online = [name for name, node in nodes.items() if node["online"]]
+        operations = {}
+        for name in online:
+            operation = nodes[name]["status"].get("operation", "unknown")
+            operations[operation] = operations.get(operation, 0) + 1
+        # 同じグループ内で設定（ETag）が揃っていないグループ
+        drift = []
+        groups = sorted({group for node in self.nodes.values() for group in node.groups})
+        for group in groups:
+            etags = {nodes[node.name]["settings_etag"] for node in self.select(group) if node.name in online}
+            if len(etags) > 1:
+                drift.append(group)
+        return {
+            "time": round(now, 3),
+            "summary": {
+                "total": len(nodes),
+                "online": len(online),
+                "offline": sorted(set(nodes) - set(online)),
+                "operations": operations,
+                "water_low": sorted(name for name in online if nodes[name]["status"].get("water_level") == "low"),
+                "groups": groups,
+                "settings_drift": drift,
+            },
+            "nodes": nodes,
+        }
+
+
+class FleetServer:
+    """まとめた状態を返し、設定の一括送信を受け付けるHTTPサーバー（keep-alive対応）"""
+    def __init__(self, fleet):
+        self.fleet = fleet
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line, headers = await read_head(reader)
+                if request_line is None:
+                    break
+                method, target, _ = request_line.split(" ", 2)
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY:
+                    await self.respond(writer, 413, {"status": "error", "message": "Request body is too large"}, False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                status, data = await self.route(method, target, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                await self.respond(writer, status, data, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, target, body):
+        url = urllib.parse.urlsplit(target)
+        query = urllib.parse.parse_qs(url.query)
+        if method == "GET" and url.path in ("/", "/api/fleet"):
+            return 200, self.fleet.status()
+        if method == "GET" and url.path.startswith("/api/fleet/nodes/"):
+            node = self.fleet.nodes.get(urllib.parse.unquote(url.path[len("/api/fleet/nodes/"):]))
+            if node is None:
+                return 404, {"status": "error", "message": "Unknown node"}
+            return 200, node.snapshot(time.time(), self.fleet.stale)
+        if method == "POST" and url.path == "/api/fleet/settings":
+            names = [name for value in query.get("node", []) for name in value.split(",") if name]
+            try:
+                settings = json.loads(body)
+                nodes = self.fleet.select(query.get("group", [None])[0], names)
+            except ValueError:
+                return 400, {"status": "error", "message": "Invalid JSON"}
+            except KeyError as e:
+                return 404, {"status": "error", "message": e.args[0]}
+            if not nodes:
+                return 404, {"status": "error", "message": "No nodes selected"}
+            results = await self.fleet.push_settings(settings, nodes)
+            ok = all(result["status"] == "success" for result in results.values())
+            return (200 if ok else 502), {"status": "success" if ok else "error", "nodes": results}
+        return 404, {"status": "error", "message": "Not found"}
+
+    async def respond(self, writer, status, data, keep_alive):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large",
+                  502: "Bad Gateway"}.get(status, "")
+        head = (f"HTTP/1.1 {status} {reason}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Cache-Control: no-cache\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+
+def load_nodes(path):
+    """設定ファイルからノードの一覧を作る（イベントループの中で呼ぶ）"""
+    with open(path) as f:
+        config = json.load(f)
+    return [Node(entry["name"], entry["url"], entry.get("groups", ())) for entry in config["nodes"]]
+
+
+async def serve(config, host, port, interval, timeout):
+    nodes = load_nodes(config)
+    fleet = Fleet(nodes, interval, timeout)
+    fleet.start()
+    server = await asyncio.start_server(FleetServer(fleet).handle, host, port)
+    logger.info("Fleet aggregator for %d nodes listening on %s:%d", len(nodes), host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await fleet.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="複数の cycle_switch ノードをまとめて監視・設定する")
+    parser.add_argument("config", help="ノード一覧のJSONファイル")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5100)
+    parser.add_argument("--interval", type=float, default=POLL_INTERVAL, help="状態を取得する間隔（秒）")
+    parser.add_argument("--timeout", type=float, default=REQUEST_TIMEOUT, help="1回の要求の待ち時間（秒）")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s", stream=sys.stderr)
+    try:
+        asyncio.run(serve(args.config, args.host, args.port, args.interval, args.timeout))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+# 集計段階（バケット幅[秒], バケット数）。細かい段階ほど保持期間が短い
+DEFAULT_TIERS = (
+    (60, 2880),     # 1分 × 2日
+    (600, 8640),    # 10分 × 60日
+    (3600, 17520),  # 1時間 × 2年
+)
+FLUSH_INTERVAL = 300  # ディスクへ書き戻す間隔（秒）。SDカードへの書き込み回数を抑える
+MAX_BUCKETS = 2000    # 1回の問い合わせで返す最大バケット数
+MAX_SCAN_SLOTS = 20000  # 1回の問い合わせで読む最大スロット数（既定の段階のバケット数より多くする）
+
+MAGIC = b"CSHIST01"
+HEADER = struct.Struct("<8sII")  # マジック, 項目数, 段階数
+TIER = struct.Struct("<II")      # バケット幅, バケット数
+RECORD = struct.Struct("<Iffdi")  # バケット開始時刻, 最小, 最大, 合計, 件数
+
+
+class History:
+    """
+    センサー値の時系列履歴。
+    項目ごと・集計段階ごとに固定長のリングバッファをメモリマップしたファイル上に持ち、
+    値を追加するたびに全段階のバケット（最小・最大・合計・件数）をその場で更新します。
+    問い合わせは生データを走査せず、要求された幅に合う集計段階から計算します。
+    """
+    def __init__(self, path, metrics, tiers=DEFAULT_TIERS):
+        self.path = path
+        self.metrics = tuple(metrics)
+        self.tiers = tuple(tiers)
+        self.lock = threading.Lock()
+        self.file = None
+        self.map = None
+        self.last_flush = 0
+        # 項目・段階ごとのリングバッファの先頭位置
+        self.offsets = {}
+        offset = HEADER.size + TIER.size * len(self.tiers)
+        for metric in self.metrics:
+            for step, capacity in self.tiers:
+                self.offsets[(metric, step)] = offset
+                offset += RECORD.size * capacity
+        self.size = offset
+
+    def header(self):
+        data = HEADER.pack(MAGIC, len(self.metrics), len(self.tiers))
+        return data + b"".join(TIER.pack(step, capacity) for step, capacity in self.tiers)
+
+    def open(self, readonly=False):
+        """
+        履歴ファイルを開く。構成が変わっていた場合は作り直す。
+        readonly の場合は書き込み側（制御デーモン）が作ったファイルを読み取り専用で共有します。
+        """
+        header = self.header()
+        if readonly:
+            self.file = open(self.path, "rb")
+            if self.file.read(len(header)) != header or os.path.getsize(self.path) != self.size:
+                self.file.close()
+                self.file = None
+                raise ValueError("History file layout does not match")
+            self.map = mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ)
+            return
+        exists = os.path.exists(self.path) and os.path.getsize(self.path) == self.size
+        self.file = open(self.path, "r+b" if exists else "w+b")
+        if exists and self.file.read(len(header)) != header:
+            exists = False
+        if not exists:
+            self.file.truncate(0)
+            self.file.truncate(self.size)
+            self.file.seek(0)
+            self.file.write(header)
+            self.file.flush()
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.flush()
+                self.map.close()
+                self.map = None
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def add(self, metric, value, timestamp=None):
+        """値を1件追加する（全段階を O(1) で更新）"""
+        if self.map is None or value is None or metric not in self.metrics:
+            return
+        timestamp = int(time.time() if timestamp is None else timestamp)
+        value = float(value)
+        with self.lock:
+            for step, capacity in self.tiers:
+                bucket = timestamp - timestamp % step
+                offset = self.offsets[(metric, step)] + RECORD.size * ((bucket // step) % capacity)
+                start, low, high, total, count = RECORD.unpack_from(self.map, offset)
+                if start != bucket:
+                    # 古い周回のバケットは上書きする
+                    low, high, total, count = value, value, 0.0, 0
+                RECORD.pack_into(self.map, offset, bucket, min(low, value), max(high, value),
+                                 total + value, count + 1)
+            if time.monotonic() - self.last_flush >= FLUSH_INTERVAL:
+                self.map.flush()
+                self.last_flush = time.monotonic()
+
+    def select_tier(self, start, step, now):
+        """要求された幅以下で最も粗く、かつ開始時刻まで保持している段階を選ぶ"""
+        tiers = sorted(self.tiers)
+        candidates = [tier for tier in tiers if tier[0] <= step] or tiers[:1]
+        tier = candidates[-1]
+        for coarser in tiers[tiers.index(tier):]:
+            tier = coarser
+            if now - coarser[0] * coarser[1] <= start:
+                break
+        return tier
+
+    def query(self, metric, start, end, step):
+        """
+        [start, end) を step 秒ごとのバケットに分け、最小・最大・平均を返す。
+        実際に使った段階の幅が step より大きい場合は step をその倍数に切り上げます。
+        """
+        if metric not in self.metrics:
+            raise ValueError(f"Unknown metric: {metric}")
+        if not all(math.isfinite(value) for value in (start, end, step)) or end <= start or step <= 0:
+            raise ValueError("Invalid range")
+        now = int(time.time())
+        tier_step, capacity = self.select_tier(start, step, now)
+        step = max(tier_step, int(step) - int(step) % tier_step)
+        first = int(start) - int(start) % step
+        if (end - first) / step > MAX_BUCKETS:
+            raise ValueError(f"Too many buckets (max {MAX_BUCKETS})")
+        # 読むのは段階に残っている範囲（最も古いバケットから現在のバケットまで）だけ
+        latest = now - now % tier_step
+        scan_start = max(first - first % tier_step, latest - tier_step * (capacity - 1))
+        scan_end = min(int(end), latest + tier_step)
+        if (scan_end - scan_start) / tier_step > MAX_SCAN_SLOTS:
+            raise ValueError(f"Too many slots to scan (max {MAX_SCAN_SLOTS})")
+
+        buckets = {}
+        base = self.offsets[(metric, tier_step)]
+        with self.lock:
+            if self.map is None:
+                raise ValueError("History is not available")
+            for bucket in range(scan_start, scan_end, tier_step):
+                offset = base + RECORD.size * ((bucket // tier_step) % capacity)
+                stored, low, high, total, count = RECORD.unpack_from(self.map, offset)
+                if stored != bucket or count == 0:
+                    continue
+                key = bucket - bucket % step
+                merged = buckets.get(key)
+                if merged is None:
+                    buckets[key] = [low, high, total, count]
+                else:
+                    merged[0] = min(merged[0], low)
+                    merged[1] = max(merged[1], high)
+                    merged[2] += total
+                    merged[3] += count
+
+        return {
+            "metric": metric,
+            "from": start,
+            "to": end,
+            "step": step,
+            "tier_step": tier_step,
+            "buckets": [
+                {"time": key, "min": low, "max": high, "mean": total / count, "count": count}
+                for key, (low, high, total, count) in sorted(buckets.items())
+            ],
+        }
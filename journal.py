@@ -0,0 +1,240 @@
+import bisect
+import json
+import logging
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+
+SEGMENT_BYTES = 1024 * 1024  # 1ファイルの上限サイズ
+SEGMENTS = 8                 # 保持するファイル数（全体の上限は SEGMENT_BYTES × SEGMENTS）
+INDEX_INTERVAL = 32          # 索引に載せる間隔（件数）
+QUEUE_SIZE = 4096            # 書き込み待ちの上限。超えた分は捨てる（呼び出し側をブロックしない）
+BATCH_SIZE = 256             # 1回の書き込みでまとめる件数
+MAX_SCAN = 5000              # 1回の問い合わせで読む最大件数
+
+INDEX = struct.Struct("<QQ")  # 通し番号, ファイル内の位置
+
+
+class Journal:
+    """
+    構造化イベント（ログ、出力・フェーズの切り替え、センサー異常、設定変更）のジャーナル。
+    emit() はキューに積むだけで戻り、書き込みスレッドがまとめてJSONL形式のファイルに追記します。
+    ファイルは一定サイズで切り替え、古いものから削除します。
+    書き込みに失敗した場合（SDカードの容量不足・故障など）はそのまとまりを捨て、次のまとまりで新しいファイルを開き直します。
+    各ファイルには INDEX_INTERVAL 件ごとの (通し番号, 位置) を記録した索引を持ち、
+    問い合わせはファイル全体を読まずに目的の位置から読み始めます。
+    """
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, segments=SEGMENTS):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segments = segments
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.thread = None
+        self.file = None
+        self.index = None
+        self.size = 0
+        self.seq = 0
+        self.dropped = 0
+        self.errors = 0       # 書き込みに失敗した回数
+        self.failing = False  # 直前のまとまりの書き込みに失敗した
+
+    def segment_path(self, first_seq, suffix):
+        return os.path.join(self.directory, f"{first_seq:012d}.{suffix}")
+
+    def list_segments(self):
+        """ファイル先頭の通し番号を昇順で返す"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[:-6]) for name in names if name.endswith(".jsonl") and name[:-6].isdigit())
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        segments = self.list_segments()
+        if segments:
+            self.recover(segments[-1])
+        else:
+            self.open_segment(1)
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join(timeout=5)
+        self.thread = None
+
+    def emit(self, type, **data):
+        """イベントを書き込み待ちに積む（ブロックしない）"""
+        if self.thread is None:
+            return
+        try:
+            self.queue.put_nowait((time.time(), type, data))
+        except queue.Full:
+            self.dropped += 1
+
+    def recover(self, first_seq):
+        """最後のファイルの末尾を確認して追記を再開する（書き込み途中の行は切り捨てる）"""
+        path = self.segment_path(first_seq, "jsonl")
+        offset, seq = self.index_position(first_seq, None)
+        if offset > os.path.getsize(path):
+            offset, seq = 0, first_seq - 1  # 索引だけが先に書かれていた
+        with open(path, "r+b") as f:
+            f.seek(offset)
+            data = f.read()
+            end = data.rfind(b"\n") + 1
+            for line in data[:end].splitlines():
+                seq = json.loads(line)["seq"]
+            f.truncate(offset + end)
+        self.seq = seq
+        self.file = open(path, "ab")
+        self.index = open(self.segment_path(first_seq, "idx"), "ab")
+        self.size = offset + end
+
+    def close_files(self):
+        for f in (self.file, self.index):
+            if f is not None:
+                try:
+                    f.close()
+                except OSError:
+                    pass
+        self.file = None
+        self.index = None
+
+    def open_segment(self, first_seq):
+        self.close_files()
+        self.file = open(self.segment_path(first_seq, "jsonl"), "ab")
+        self.index = open(self.segment_path(first_seq, "idx"), "ab")
+        self.size = 0
+        # 古いファイルを削除する
+        segments = self.list_segments()
+        for old in segments[:max(0, len(segments) - self.segments)]:
+            for suffix in ("jsonl", "idx"):
+                try:
+                    os.unlink(self.segment_path(old, suffix))
+                except FileNotFoundError:
+                    pass
+
+    def writer(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            items = [item for item in batch if item is not None]
+            written = 0
+            try:
+                if self.file is None or self.index is None:
+                    self.open_segment(self.seq + 1)  # 失敗したファイルには追記しない
+                for item in items:
+                    self.write(*item)
+                    written += 1
+                self.file.flush()
+                self.index.flush()
+            except OSError as e:
+                self.write_failed(e, len(items) - written)
+            else:
+                if self.failing:
+                    self.failing = False
+                    print("Journal writes recovered", file=sys.stderr)
+            if None in batch:
+                self.close_files()
+                return
+
+    def write_failed(self, error, lost):
+        """
+        書き込みの失敗を数え、ファイルを閉じる（次のまとまりで開き直す）。
+        ログもジャーナルに書くため、失敗は標準エラー出力に知らせます（続けて失敗する間は1回だけ）。
+        """
+        self.errors += 1
+        self.dropped += lost
+        self.close_files()
+        if not self.failing:
+            self.failing = True
+            print(f"Journal write failed, dropping events until it recovers: {error}", file=sys.stderr)
+
+    def write(self, timestamp, type, data):
+        self.seq += 1
+        record = {"seq": self.seq, "time": round(timestamp, 3), "type": type}
+        record.update(data)
+        line = (json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=str) + "\n").encode("utf-8")
+        if self.size > 0 and self.size + len(line) > self.segment_bytes:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.open_segment(self.seq)
+        if self.size == 0 or self.seq % INDEX_INTERVAL == 0:
+            self.index.write(INDEX.pack(self.seq, self.size))
+        self.file.write(line)
+        self.size += len(line)
+
+    def index_position(self, first_seq, seq):
+        """
+        ファイル内で通し番号 seq 以前の最も近い索引の (位置, その直前の通し番号) を返す。
+        seq が None の場合は最後の索引を使う。
+        """
+        try:
+            with open(self.segment_path(first_seq, "idx"), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return 0, first_seq - 1
+        entries = [INDEX.unpack_from(data, i) for i in range(0, len(data) - INDEX.size + 1, INDEX.size)]
+        if not entries:
+            return 0, first_seq - 1
+        i = len(entries) if seq is None else bisect.bisect_right(entries, (seq, float("inf")))
+        if i == 0:
+            return 0, first_seq - 1
+        indexed_seq, offset = entries[i - 1]
+        return offset, indexed_seq - 1
+
+    def query(self, since=0, types=None, limit=100):
+        """
+        通し番号 since より後のイベントを最大 limit 件返す。
+        types を指定するとその種類だけを返します。続きは戻り値の "next" を since に指定して取得します。
+        """
+        segments = self.list_segments()
+        events = []
+        scanned = 0
+        next_seq = since
+        start = max(0, bisect.bisect_right(segments, since + 1) - 1)
+        for first_seq in segments[start:]:
+            offset = self.index_position(first_seq, since + 1)[0] if first_seq <= since else 0
+            try:
+                f = open(self.segment_path(first_seq, "jsonl"), "rb")
+            except FileNotFoundError:
+                continue  # 読み取り中に削除された
+            with f:
+                f.seek(offset)
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # 書き込み途中の行
+                    if record["seq"] <= since:
+                        continue
+                    scanned += 1
+                    next_seq = record["seq"]
+                    if types is None or record["type"] in types:
+                        events.append(record)
+                    if len(events) >= limit or scanned >= MAX_SCAN:
+                        return {"events": events, "next": next_seq, "more": True}
+        return {"events": events, "next": next_seq, "more": False}
+
+
+class JournalHandler(logging.Handler):
+    """ログをジャーナルの "log" イベントとして書き込むハンドラー"""
+    def __init__(self, journal):
+        super().__init__()
+        self.journal = journal
+
+    def emit(self, record):
+        try:
+            self.journal.emit("log", level=record.levelname, message=record.getMessage())
+        except Exception:
+            self.handleError(record)
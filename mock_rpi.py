@@ -1,6 +1,123 @@
+import importlib.util
+import io
+import math
+import os
+import random
 import sys
+import time
 import types
 
+# ---- 動作モード ----
+# "verbose"  : 従来どおり、呼び出しごとに内容を表示する
+# "emulator" : 表示せず、実機に近い遅延・時間変化する値・確率的な故障を再現する
+# 環境変数 MOCK_RPI_MODE などで指定するか、configure() で変更します。
+class EmulatorConfig:
+    def __init__(self):
+        self.mode = os.environ.get("MOCK_RPI_MODE", "verbose")
+        self.latency = os.environ.get("MOCK_RPI_LATENCY", "1") != "0"  # 遅延を再現するか
+        self.time_scale = 1.0  # 遅延の倍率
+        self.fault_rate = float(os.environ.get("MOCK_RPI_FAULT_RATE", "0.01"))  # I2C・1-Wireの故障率
+        self.dht_failure_rate = float(os.environ.get("MOCK_RPI_DHT_FAILURE_RATE", "0.3"))  # DHT11のチェックサム異常率
+        self.hang_rate = float(os.environ.get("MOCK_RPI_HANG_RATE", "0"))  # センサーが応答しなくなる確率
+        self.hang_time = 10.0  # 応答しない場合の待ち時間（秒）
+        self.w1_resolution = 12  # DS18B20 の分解能（9〜12ビット）
+        self.i2c_clock = 100000  # I2Cクロック（Hz）
+        self.clock = time.time  # 信号の時間変化に使う時計
+        self.random = random.Random(os.environ.get("MOCK_RPI_SEED"))
+
+config = EmulatorConfig()
+
+def configure(**options):
+    """エミュレーターの設定を変更する（例: configure(mode="emulator", fault_rate=0)）"""
+    for name, value in options.items():
+        if name == "seed":
+            config.random = random.Random(value)
+        elif hasattr(config, name):
+            setattr(config, name, value)
+        else:
+            raise AttributeError(f"Unknown emulator option: {name}")
+
+def emulating():
+    return config.mode == "emulator"
+
+def log(message):
+    if not emulating():
+        print(message)
+
+def delay(seconds):
+    """エミュレーターモードでは実機の処理時間ぶん待つ"""
+    if emulating() and config.latency and seconds > 0:
+        time.sleep(seconds * config.time_scale)
+
+def fault(rate=None):
+    """エミュレーターモードで、指定確率で故障を発生させるか判定する"""
+    return emulating() and config.random.random() < (config.fault_rate if rate is None else rate)
+
+class SensorSignals:
+    """時刻によって変化するセンサー値（1日周期の変化 + ノイズ）"""
+    DAY = 24 * 3600
+
+    def daily(self, peak_hour):
+        """peak_hour に最大となる -1〜1 の値"""
+        t = config.clock() % self.DAY
+        return math.cos(2 * math.pi * (t - peak_hour * 3600) / self.DAY)
+
+    def noise(self, scale):
+        return config.random.gauss(0, scale)
+
+    def air_temperature(self):
+        return 22 + 5 * self.daily(14) + self.noise(0.3)
+
+    def humidity(self):
+        return min(95, max(20, 60 - 15 * self.daily(14) + self.noise(1.5)))
+
+    def water_temperature(self):
+        return 20 + 2 * self.daily(16) + self.noise(0.05)
+
+    def brightness_voltage(self):
+        # 明るいほど電圧が下がる（app.get_brightness の換算に合わせる）
+        light = max(0.0, self.daily(12))
+        return min(5.0, max(0.0, 5.0 - 4.5 * light + self.noise(0.05)))
+
+    def tds_voltage(self):
+        return max(0.0, 1.2 + 0.05 * self.daily(6) + self.noise(0.02))
+
+signals = SensorSignals()
+
+# ---- 1-Wire (DS18B20) ----
+# DS18B20 の変換時間（分解能ごと、秒）
+W1_CONVERSION_TIME = {9: 0.09375, 10: 0.1875, 11: 0.375, 12: 0.75}
+
+def w1_write(path, value):
+    """
+    1-Wireデバイスの設定ファイル（resolution など）に書き込む。
+    エミュレーターモードでは分解能の設定を変換時間と値の刻みに反映します。
+    """
+    if not emulating():
+        with open(path, "w") as f:
+            f.write(value)
+        return
+    if path.endswith("/resolution"):
+        config.w1_resolution = int(value)
+    log(f"[Mock w1] {path} <- {value}")
+
+def w1_open(path):
+    """
+    1-Wireデバイスファイル（w1_slave）を開く。
+    エミュレーターモードでは変換時間だけ待ってから DS18B20 の出力を模擬したファイルを返します。
+    """
+    if not emulating():
+        return open(path, "r")
+    if fault(config.hang_rate):
+        time.sleep(config.hang_time)
+    delay(W1_CONVERSION_TIME.get(config.w1_resolution, 0.75))
+    step = 0.0625 * 2 ** (12 - config.w1_resolution)
+    millidegrees = int(round(signals.water_temperature() / step) * step * 1000)
+    crc = "NO" if fault() else "YES"
+    return io.StringIO(
+        f"50 01 4b 46 7f ff 0c 10 1c : crc=1c {crc}\n"
+        f"50 01 4b 46 7f ff 0c 10 1c t={millidegrees}\n")
+
 # ---- Mock RPi.GPIO ----
 try:
     import RPi.GPIO as GPIO
@@ -10,15 +127,15 @@ except ImportError:
         def __init__(self, pin, frequency):
             self.pin = pin
             self.frequency = frequency
-            print(f"MockGPIO: PWM.__init__({pin}, {frequency})")
+            log(f"MockGPIO: PWM.__init__({pin}, {frequency})")
         def start(self, duty_cycle):
-            print(f"MockGPIO: PWM.start({duty_cycle})")
+            log(f"MockGPIO: PWM.start({duty_cycle})")
         def ChangeDutyCycle(self, duty_cycle):
-            print(f"MockGPIO: PWM.ChangeDutyCycle({duty_cycle})")
+            log(f"MockGPIO: PWM.ChangeDutyCycle({duty_cycle})")
         def ChangeFrequency(self, frequency):
-            print(f"MockGPIO: PWM.ChangeFrequency({frequency})")
+            log(f"MockGPIO: PWM.ChangeFrequency({frequency})")
         def stop(self):
-            print("MockGPIO: PWM.stop()")
+            log("MockGPIO: PWM.stop()")
     
     class MockGPIO:
         BOARD = "BOARD"
@@ -36,58 +153,98 @@ except ImportError:
 
         def __init__(self):
             self.pins = {}
+            self.levels = {}  # 入力ピンの現在のレベル
+            self.callbacks = {}  # ピン -> (エッジ, コールバック)
+            self.trace = None  # 出力の記録（start_traceで開始）
+            self.trace_clock = None
 
         def setmode(self, mode):
-            print(f"MockGPIO: setmode({mode})")
-
-        def setup(self, pin, mode, pull_up_down=None):
-            self.pins[pin] = mode
-            print(f"MockGPIO: setup({pin}, {mode}, pull_up_down={pull_up_down})")
+            log(f"MockGPIO: setmode({mode})")
+
+        def setup(self, pin, mode, pull_up_down=None, initial=None):
+            # RPi.GPIO と同じく、ピンのリストも受け付ける
+            for p in pin if isinstance(pin, (list, tuple)) else [pin]:
+                self.pins[p] = mode
+                if mode == self.IN:
+                    # プルアップなら HIGH、それ以外は LOW から始める
+                    self.levels.setdefault(p, self.HIGH if pull_up_down == self.PUD_UP else self.LOW)
+                elif initial is not None:
+                    self.levels[p] = initial
+            log(f"MockGPIO: setup({pin}, {mode}, pull_up_down={pull_up_down}, initial={initial})")
 
         def output(self, pin, state):
-            if pin not in self.pins:
-                raise RuntimeError(f"Pin {pin} not set up.")
-            if state == self.HIGH:
-                state_str = "HIGH"
-            elif state == self.LOW:
-                state_str = "LOW"
-            else:
-                state_str = str(state)
-            print(f"MockGPIO: output({pin}, {state_str})")
+            # RPi.GPIO と同じく output([ピン...], 値) と output([ピン...], [値...]) も受け付ける
+            pins = list(pin) if isinstance(pin, (list, tuple)) else [pin]
+            states = list(state) if isinstance(state, (list, tuple)) else [state] * len(pins)
+            if len(states) != len(pins):
+                raise RuntimeError("Number of channels != number of values")
+            for p in pins:
+                if p not in self.pins:
+                    raise RuntimeError(f"Pin {p} not set up.")
+            at = self.trace_clock() if self.trace is not None else None
+            for p, value in zip(pins, states):
+                self.levels[p] = value
+                if self.trace is not None:
+                    self.trace.append((at, p, value))
+            name = lambda value: "HIGH" if value == self.HIGH else "LOW" if value == self.LOW else str(value)
+            log(f"MockGPIO: output({pin}, {[name(v) for v in state] if isinstance(state, (list, tuple)) else name(state)})")
+
+        def start_trace(self, clock):
+            """出力の記録を開始する。clock は記録する時刻を返す関数"""
+            self.trace_clock = clock
+            self.trace = []
+
+        def stop_trace(self):
+            """記録を終了し、(時刻, ピン, 出力) のリストを返す"""
+            trace, self.trace = self.trace or [], None
+            return trace
 
         def input(self, pin):
             if pin not in self.pins:
                 raise RuntimeError(f"Pin {pin} not set up.")
-            print(f"MockGPIO: input({pin})")
-            return self.HIGH  # 常に HIGH を返す
+            log(f"MockGPIO: input({pin})")
+            return self.levels.get(pin, self.HIGH)
+
+        def set_input(self, pin, level):
+            """テスト用：入力ピンのレベルを変更し、登録されたエッジ検出コールバックを呼ぶ"""
+            previous = self.levels.get(pin)
+            self.levels[pin] = level
+            log(f"MockGPIO: set_input({pin}, {level})")
+            if pin not in self.callbacks or previous == level:
+                return
+            edge, callback = self.callbacks[pin]
+            rising = level == self.HIGH
+            if edge == self.BOTH or (edge == self.RISING) == rising:
+                callback(pin)
 
         def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
-            print(f"MockGPIO: add_event_detect({channel}, {edge}, callback={callback}, bouncetime={bouncetime})")
+            if callback is not None:
+                self.callbacks[channel] = (edge, callback)
+            log(f"MockGPIO: add_event_detect({channel}, {edge}, callback={callback}, bouncetime={bouncetime})")
 
         def remove_event_detect(self, channel):
-            print(f"MockGPIO: remove_event_detect({channel})")
+            self.callbacks.pop(channel, None)
+            log(f"MockGPIO: remove_event_detect({channel})")
 
         def event_detected(self, channel):
-            print(f"MockGPIO: event_detected({channel})")
+            log(f"MockGPIO: event_detected({channel})")
             return False
 
         def wait_for_edge(self, channel, edge, timeout=None):
-            print(f"MockGPIO: wait_for_edge({channel}, {edge}, timeout={timeout})")
+            log(f"MockGPIO: wait_for_edge({channel}, {edge}, timeout={timeout})")
             return channel
 
         def cleanup(self):
-            print("MockGPIO: cleanup()")
+            log("MockGPIO: cleanup()")
 
         def setwarnings(self, flag):
-            print(f"MockGPIO: setwarnings({flag})")
+            log(f"MockGPIO: setwarnings({flag})")
 
     sys.modules["RPi"] = types.ModuleType("RPi")
     sys.modules["RPi.GPIO"] = MockGPIO()
 
 # ---- Mock board (Adafruit) ----
-try:
-    import board
-except ImportError:
+if importlib.util.find_spec("board") is None:
     class MockBoard:
         D5 = "D5"
         D18 = "D18"
@@ -97,9 +254,7 @@ except ImportError:
     sys.modules["board"] = MockBoard()
 
 # ---- Mock neopixel (Adafruit) ----
-try:
-    import neopixel
-except ImportError:
+if importlib.util.find_spec("neopixel") is None:
     class MockNeoPixel:
         def __init__(self, pin, num_pixels, brightness=1.0, auto_write=True, pixel_order=None):
             self.pin = pin
@@ -107,93 +262,157 @@ except ImportError:
             self.brightness = brightness
             self.auto_write = auto_write
             self.pixels = [(0, 0, 0)] * num_pixels
-            print(f"[Mock NeoPixel] Initialized on {pin} with {num_pixels} pixels")
+            log(f"[Mock NeoPixel] Initialized on {pin} with {num_pixels} pixels")
 
         def show(self):
-            print(f"[Mock NeoPixel] Showing pixels: {self.pixels}")
+            log(f"[Mock NeoPixel] Showing pixels: {self.pixels}")
 
         def __setitem__(self, index, color):
             if 0 <= index < self.num_pixels:
                 self.pixels[index] = color
-                print(f"[Mock NeoPixel] Set pixel {index} to {color}")
+                log(f"[Mock NeoPixel] Set pixel {index} to {color}")
             else:
-                print(f"[Mock NeoPixel] Index {index} out of range")
+                log(f"[Mock NeoPixel] Index {index} out of range")
 
         def __getitem__(self, index):
             return self.pixels[index]
 
         def fill(self, color):
             self.pixels = [color] * self.num_pixels
-            print(f"[Mock Neo Pixel] Filled all pixels with {color}")
+            log(f"[Mock Neo Pixel] Filled all pixels with {color}")
 
     sys.modules["neopixel"] = types.ModuleType("neopixel")
     sys.modules["neopixel"].NeoPixel = MockNeoPixel
 
 # ---- Mock smbus ----
-try:
-    import smbus
-except ImportError:
+if importlib.util.find_spec("smbus") is None:
     class MockSMBus:
+        PCF8591_ADDR = 0x48
+
         def __init__(self, bus):
             self.bus = bus
-            print(f"[Mock smbus] SMBus({bus}) initialized")
+            self.control = 0  # PCF8591 の制御バイト
+            self.last_conversion = 0x80  # 直前の変換結果（次の読み出しの先頭で返る）
+            log(f"[Mock smbus] SMBus({bus}) initialized")
+
+        def transfer(self, addr, nbytes):
+            """I2C転送の時間を待ち、確率的に NACK（OSError）を発生させる"""
+            # アドレス + データの各バイトは9クロック、開始・停止条件ぶんを加える
+            delay((9 * (nbytes + 1) + 2) / config.i2c_clock + 50e-6)
+            if fault():
+                raise OSError(121, "Remote I/O error")
+
+        def adc_channel(self, channel):
+            """PCF8591 のチャンネル値（0-255）"""
+            if channel == 0:
+                voltage = signals.brightness_voltage()
+            elif channel == 2:
+                voltage = signals.tds_voltage()
+            else:
+                voltage = 2.5 + signals.noise(0.01)
+            return min(255, max(0, int(voltage * 255 / 5)))
+
+        def convert(self):
+            """PCF8591 の変換を1回行い、直前の変換結果を返す（自動インクリメントに対応）"""
+            channel = self.control & 0x03
+            previous = self.last_conversion
+            self.last_conversion = self.adc_channel(channel)
+            if self.control & 0x04:
+                self.control = (self.control & ~0x03) | ((channel + 1) & 0x03)
+            return previous
 
         def write_byte(self, addr, value):
-            print(f"[Mock smbus] write_byte(addr={addr}, value={value})")
+            self.transfer(addr, 1)
+            self.control = value
+            log(f"[Mock smbus] write_byte(addr={addr}, value={value})")
 
         def write_byte_data(self, addr, reg, value):
-            print(f"[Mock smbus] write_byte_data(addr={addr}, reg={reg}, value={value})")
+            self.transfer(addr, 2)
+            log(f"[Mock smbus] write_byte_data(addr={addr}, reg={reg}, value={value})")
 
         def read_byte(self, addr):
-            print(f"[Mock smbus] read_byte(addr={addr})")
-            return 0x20
+            log(f"[Mock smbus] read_byte(addr={addr})")
+            if not emulating():
+                return 0x20
+            self.transfer(addr, 1)
+            return self.convert()
 
         def read_byte_data(self, addr, reg):
-            print(f"[Mock smbus] read_byte_data(addr={addr}, reg={reg}) -> returning 0x00")
+            log(f"[Mock smbus] read_byte_data(addr={addr}, reg={reg}) -> returning 0x00")
+            self.transfer(addr, 2)
             return 0x00  # ダミーの戻り値
 
         def read_word_data(self, addr, reg):
-            print(f"[Mock smbus] read_word_data(addr={addr}, reg={reg}) -> returning 0x0000")
+            log(f"[Mock smbus] read_word_data(addr={addr}, reg={reg}) -> returning 0x0000")
+            self.transfer(addr, 3)
             return 0x0000  # ダミーの戻り値
 
         def write_i2c_block_data(self, addr, reg, data):
-            print(f"[Mock smbus] write_i2c_block_data(addr={addr}, reg={reg}, data={data})")
+            self.transfer(addr, 1 + len(data))
+            log(f"[Mock smbus] write_i2c_block_data(addr={addr}, reg={reg}, data={data})")
 
         def read_i2c_block_data(self, addr, reg, length):
-            print(f"[Mock smbus] read_i2c_block_data(addr={addr}, reg={reg}, length={length}) -> returning {length} zeros")
-            return [0x00] * length  # 指定された長さのゼロのリストを返す
+            log(f"[Mock smbus] read_i2c_block_data(addr={addr}, reg={reg}, length={length}) -> returning {length} zeros")
+            if not emulating():
+                return [0x00] * length  # 指定された長さのゼロのリストを返す
+            # 制御バイトの書き込み + length バイトの読み出し
+            self.transfer(addr, 2 + length)
+            self.control = reg
+            return [self.convert() for i in range(length)]
+
+        def close(self):
+            log(f"[Mock smbus] SMBus({self.bus}) closed")
 
     sys.modules["smbus"] = types.ModuleType("smbus")
     sys.modules["smbus"].SMBus = MockSMBus
 
     # ---- Mock adafruit_dht ----
-try:
-    import adafruit_dht
-except ImportError:
+if importlib.util.find_spec("adafruit_dht") is None:
     class MockAdafruitDHT:
         DHT11 = "DHT11"
         DHT22 = "DHT22"
 
+        MIN_INTERVAL = 2.0  # DHT11は2秒以内の再読み取りでは前回の値を返す
+        READ_TIME = 0.025   # 1回の読み取りにかかる時間（秒）
+
         def __init__(self, sensor, pin):
             self.sensor = sensor
             self.pin = pin
-            print(f"MockAdafruitDHT: Initialized {sensor} on pin {pin}")
+            self.last_read = None
+            self.values = (None, None)
+            log(f"MockAdafruitDHT: Initialized {sensor} on pin {pin}")
+
+        def measure(self):
+            now = time.monotonic()
+            if self.last_read is not None and now - self.last_read < self.MIN_INTERVAL:
+                return
+            self.last_read = now
+            delay(self.READ_TIME)
+            if fault(config.dht_failure_rate):
+                raise RuntimeError("Checksum did not validate. Try again.")
+            self.values = (round(signals.air_temperature()), round(signals.humidity()))
 
         @property
         def temperature(self):
-            print(f"MockAdafruitDHT: Reading temperature")
-            return 25.0  # Mock temperature
+            log(f"MockAdafruitDHT: Reading temperature")
+            if not emulating():
+                return 25.0  # Mock temperature
+            self.measure()
+            return self.values[0]
 
         @property
         def humidity(self):
-            print(f"MockAdafruitDHT: Reading humidity")
-            return 50.0  # Mock humidity
+            log(f"MockAdafruitDHT: Reading humidity")
+            if not emulating():
+                return 50.0  # Mock humidity
+            self.measure()
+            return self.values[1]
 
 
     sys.modules["adafruit_dht"] = types.ModuleType("adafruit_dht")
 #    sys.modules["adafruit_dht"].DHT11 = MockAdafruitDHT.DHT11
 #    sys.modules["adafruit_dht"].DHT22 = MockAdafruitDHT.DHT22
-    sys.modules["adafruit_dht"].DHT11 = lambda pin: MockAdafruitDHT(MockAdafruitDHT.DHT11, pin)
-    sys.modules["adafruit_dht"].DHT22 = lambda pin: MockAdafruitDHT(MockAdafruitDHT.DHT22, pin)
+    sys.modules["adafruit_dht"].DHT11 = lambda pin, **kwargs: MockAdafruitDHT(MockAdafruitDHT.DHT11, pin)
+    sys.modules["adafruit_dht"].DHT22 = lambda pin, **kwargs: MockAdafruitDHT(MockAdafruitDHT.DHT22, pin)
     sys.modules["adafruit_dht"].DHT = MockAdafruitDHT
 
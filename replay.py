@@ -0,0 +1,112 @@
+"""
+設定ファイルのスケジュールを仮想時計で再生し、GPIO出力の記録（トレース）を出力します。
+2つの設定ファイルを指定すると、トレースの差分を表示します。
+mock_rpi のGPIOモックが必要です（実機では動作しません）。
+
+使い方:
+    python replay.py settings.json
+    python replay.py --days 7 --start 2026-01-01 settings.json new_settings.json
+    python replay.py --speed 1000 --output trace.csv settings.json
+"""
+import argparse
+import contextlib
+import csv
+import io
+import json
+import logging
+import sys
+from datetime import datetime, timedelta
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import app
+    import RPi.GPIO as GPIO
+
+# GPIOピン -> チャンネル名
+PIN_CHANNELS = {pin: channel for channel, pins in app.OUTPUT_CHANNELS.items() for pin in pins}
+
+
+def replay(settings, start, days, speed=None):
+    """仮想時計で設定を再生し、(時刻, ピン, 出力) のリストを返す"""
+    if not hasattr(GPIO, "start_trace"):
+        raise RuntimeError("replay requires the mock_rpi GPIO backend")
+    end = start + timedelta(days=days)
+    clock = app.VirtualClock(start, speed=speed, until=end)
+    with contextlib.redirect_stdout(io.StringIO()):
+        controller = app.Controller(clock=clock)
+        controller.setup()
+        GPIO.start_trace(clock.now)
+        controller.start(app.normalize_settings(settings))
+        clock.finished.wait()
+        controller.stop()
+        controller.led.close()
+        trace = GPIO.stop_trace()
+    return [(at, pin, state) for at, pin, state in trace if start <= at < end]
+
+
+def transitions(trace):
+    """トレースから、状態が変化した出力だけを (時刻, ピン, 出力) で返す"""
+    levels = {}
+    result = []
+    for at, pin, state in trace:
+        if levels.get(pin) != state:
+            levels[pin] = state
+            result.append((at.replace(microsecond=0), pin, state))
+    return result
+
+
+def write_trace(rows, output):
+    writer = csv.writer(output)
+    writer.writerow(["time", "pin", "channel", "state"])
+    for at, pin, state in rows:
+        writer.writerow([at.isoformat(), pin, PIN_CHANNELS.get(pin, ""), state])
+
+
+def compare(name_a, rows_a, name_b, rows_b):
+    """2つのトレースをチャンネル単位で比較し、差分を表示する。一致すれば True"""
+    channels_a = {(at, PIN_CHANNELS.get(pin, pin), state) for at, pin, state in rows_a}
+    channels_b = {(at, PIN_CHANNELS.get(pin, pin), state) for at, pin, state in rows_b}
+    only_a = sorted(channels_a - channels_b)
+    only_b = sorted(channels_b - channels_a)
+    print(f"{name_a}: {len(channels_a)} transitions, {name_b}: {len(channels_b)} transitions")
+    print(f"only in {name_a}: {len(only_a)}, only in {name_b}: {len(only_b)}")
+    for label, rows in ((name_a, only_a), (name_b, only_b)):
+        for at, channel, state in rows[:10]:
+            print(f"  {label}: {at.isoformat()} {channel} -> {state}")
+    if only_a or only_b:
+        first = min(only_a[:1] + only_b[:1])
+        print(f"first difference at {first[0].isoformat()}")
+    return not only_a and not only_b
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("settings", nargs="+", help="settings.json（2つ指定すると比較）")
+    parser.add_argument("--days", type=float, default=1, help="再生する日数")
+    parser.add_argument("--start", default=None, help="開始日時（ISO形式、既定は今日の0時）")
+    parser.add_argument("--speed", type=float, default=None,
+                        help="仮想時計の倍率（省略時は待ち時間なしで進める）")
+    parser.add_argument("--output", default=None, help="トレースCSVの出力先（既定は標準出力）")
+    args = parser.parse_args(argv)
+
+    app.setup_logger(to_journal=False)
+    app.logger.setLevel(logging.WARNING)
+    start = (datetime.fromisoformat(args.start) if args.start
+             else datetime.combine(datetime.now().date(), datetime.min.time()))
+
+    traces = []
+    for path in args.settings[:2]:
+        with open(path) as f:
+            traces.append((path, transitions(replay(json.load(f), start, args.days, args.speed))))
+
+    if len(traces) == 2:
+        return 0 if compare(traces[0][0], traces[0][1], traces[1][0], traces[1][1]) else 1
+    if args.output:
+        with open(args.output, "w", newline="") as f:
+            write_trace(traces[0][1], f)
+    else:
+        write_trace(traces[0][1], sys.stdout)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,144 @@
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = b"CSSTATE1"
+# マジック, レイアウトのハッシュ, 更新カウンター（奇数は書き込み中）, 書き込み側のPID, 更新時刻
+HEADER = struct.Struct("<8s8sIId")
+SEQ_OFFSET = 16
+# 動作状態, フェーズ, 制御ON/OFF, 水位低下, 出力（チャンネルごとのビット）, 設定バージョン, 設定ETag,
+# 最後の水位変化の時刻, イベント番号
+CONTROL = struct.Struct("<16s16s??IIx16sdI")
+# 値（NaNは未取得）, 取得時刻（NaNは未取得）, 状態
+SAMPLE = struct.Struct("<dd8s")
+
+READ_RETRIES = 100
+
+
+def encode(text, size):
+    return (text or "").encode("utf-8")[:size]
+
+
+def decode(data):
+    return data.rstrip(b"\0").decode("utf-8")
+
+
+def nan_to_none(value):
+    return None if math.isnan(value) else value
+
+
+class SharedState:
+    """
+    制御デーモンが公開する状態の共有メモリブロック（固定レイアウト）。
+    書き込みは1プロセスだけが行い、読み取り側は更新カウンター（シーケンスロック）で
+    書き込み途中の値を読まないようにします。読み取りはメモリマップから直接行い、ブロック全体をコピーしません。
+    """
+    def __init__(self, path, channels, fields):
+        self.path = path
+        self.channels = tuple(channels)
+        self.fields = tuple(fields)
+        layout = ",".join(self.channels) + "|" + ",".join(self.fields)
+        self.layout = hashlib.sha1(layout.encode("utf-8")).digest()[:8]
+        self.size = HEADER.size + CONTROL.size + SAMPLE.size * len(self.fields)
+        self.map = None
+        self.file = None
+        self.writable = False
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def create(self):
+        """書き込み側としてブロックを作成する"""
+        self.file = open(self.path, "w+b")
+        self.file.truncate(self.size)
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+        self.writable = True
+        HEADER.pack_into(self.map, 0, MAGIC, self.layout, 0, os.getpid(), time.time())
+
+    def attach(self):
+        """読み取り側としてブロックを開く（書き込み側が作成するまでは FileNotFoundError）"""
+        self.file = open(self.path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ)
+        magic, layout = HEADER.unpack_from(self.map, 0)[:2]
+        if magic != MAGIC or layout != self.layout:
+            self.close()
+            raise ValueError("Shared state layout does not match")
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.writable and os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def write(self, state):
+        """状態を書き込む。state は read() が返すものと同じ形式の辞書"""
+        outputs = state.get("outputs", {})
+        mask = sum(1 << i for i, channel in enumerate(self.channels) if outputs.get(channel))
+        samples = state.get("samples", {})
+        with self.lock:
+            self.seq += 1
+            struct.pack_into("<I", self.map, SEQ_OFFSET, self.seq)  # 奇数：書き込み中
+            offset = HEADER.size
+            CONTROL.pack_into(
+                self.map, offset,
+                encode(state.get("operation"), 16), encode(state.get("phase"), 16),
+                bool(state.get("control_enabled")), bool(state.get("water_low")),
+                mask, state.get("settings_version", 0), encode(state.get("settings_etag"), 16),
+                state.get("water_event_time") or math.nan, state.get("event_id", 0))
+            offset += CONTROL.size
+            for field in self.fields:
+                value, timestamp, status = samples.get(field, (None, None, "pending"))
+                SAMPLE.pack_into(self.map, offset,
+                                 math.nan if value is None else value,
+                                 math.nan if timestamp is None else timestamp,
+                                 encode(status, 8))
+                offset += SAMPLE.size
+            self.seq += 1
+            HEADER.pack_into(self.map, 0, MAGIC, self.layout, self.seq, os.getpid(), time.time())
+
+    def sequence(self):
+        """更新カウンター（変化の検出用）"""
+        return struct.unpack_from("<I", self.map, SEQ_OFFSET)[0]
+
+    def read(self):
+        """書き込み途中でない状態を読み取って辞書で返す"""
+        for i in range(READ_RETRIES):
+            seq = self.sequence()
+            if seq % 2:
+                time.sleep(0)
+                continue
+            magic, layout, seq, pid, updated = HEADER.unpack_from(self.map, 0)
+            offset = HEADER.size
+            (operation, phase, control_enabled, water_low, mask, settings_version, settings_etag,
+             water_event_time, event_id) = CONTROL.unpack_from(self.map, offset)
+            offset += CONTROL.size
+            samples = {}
+            for field in self.fields:
+                value, timestamp, status = SAMPLE.unpack_from(self.map, offset)
+                samples[field] = (nan_to_none(value), nan_to_none(timestamp), decode(status))
+                offset += SAMPLE.size
+            if self.sequence() != seq:
+                continue  # 読み取り中に更新された
+            return {
+                "seq": seq,
+                "pid": pid,
+                "updated": updated,
+                "operation": decode(operation),
+                "phase": decode(phase),
+                "control_enabled": control_enabled,
+                "water_low": water_low,
+                "outputs": {channel: bool(mask & (1 << i)) for i, channel in enumerate(self.channels)},
+                "settings_version": settings_version,
+                "settings_etag": decode(settings_etag),
+                "water_event_time": nan_to_none(water_event_time),
+                "event_id": event_id,
+                "samples": samples,
+            }
+        raise TimeoutError("Shared state is being updated continuously")
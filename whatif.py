@@ -0,0 +1,255 @@
+"""
+スケジュール設定の what-if シミュレーター。
+多数の候補設定を NumPy の配列でまとめて評価し、1日あたりのポンプごとのON時間・デューティ比・
+水中ポンプが両方とも止まっている最長時間（最長乾燥時間）・出力の切り替え回数を求めます。
+設定は save_settings と同じ normalize_settings で検証し、Schedule と同じ規則で展開します
+（前日から続くブロックや、重なったブロックの扱いを含む）。水位低下による停止は考慮しません。
+
+使い方:
+    python whatif.py settings.json
+    python whatif.py --base settings.json --sweep interval_output2_on=1:10:1 --sweep interval_both_off=0:30:5
+    python whatif.py --candidates candidates.json --resolution 1 --sort longest_dry_gap --output result.csv
+"""
+import argparse
+import contextlib
+import csv
+import io
+import itertools
+import json
+import sys
+import time
+
+import numpy as np
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import app
+
+DAY = 24 * 3600
+DAYS_BEFORE = 2        # 前日・前々日から続くブロックも評価する
+MAX_NIGHT_CYCLES = 3   # normalize_settings が受け付ける夜間動作の数
+CHUNK_CELLS = 20_000_000  # 1回に作る (候補 × 時刻 × ブロック) 配列の最大要素数
+
+# 状態コード
+IDLE, LEFT, RIGHT, OFF = 0, 1, 2, 3
+CHANNEL_STATES = {"air": (LEFT, RIGHT, OFF), "left": (LEFT,), "right": (RIGHT,)}
+METRICS = ("left_on", "right_on", "air_on", "left_duty", "right_duty", "air_duty",
+           "longest_dry_gap", "left_switches", "right_switches", "air_switches", "switches")
+
+
+def seconds_of_day(value):
+    t = app.parse_time(value)
+    return t.hour * 3600 + t.minute * 60 + t.second
+
+
+def to_arrays(candidates):
+    """正規化した設定の一覧を、候補ごとのパラメーター配列に変換する"""
+    n = len(candidates)
+    params = {
+        "left": np.zeros(n), "right": np.zeros(n), "off": np.zeros(n),
+        "start": np.zeros(n), "end": np.zeros(n), "enabled": np.zeros(n, dtype=bool),
+        "night": np.full((n, MAX_NIGHT_CYCLES), np.nan),
+    }
+    for i, settings in enumerate(candidates):
+        params["left"][i] = settings["interval_output2_on"] * 60
+        params["right"][i] = settings["interval_output3_on"] * 60
+        params["off"][i] = settings["interval_both_off"] * 60
+        params["start"][i] = seconds_of_day(settings["start_time"])
+        params["end"][i] = seconds_of_day(settings["end_time"])
+        params["enabled"][i] = bool(settings.get("control_enabled", True))
+        nights = sorted(seconds_of_day(t) for t in settings.get("night_cycle_times", []))
+        params["night"][i, :len(nights)] = nights[:MAX_NIGHT_CYCLES]
+    return params
+
+
+def day_blocks(p):
+    """
+    Schedule.blocks と同じ規則で、1日分のブロック (開始, 終了, 日中か) を (候補, ブロック) の配列で返す。
+    無効なブロックの開始は NaN。
+    """
+    n = len(p["left"])
+    period = p["left"] + p["right"] + p["off"]
+    night_length = p["left"] + p["right"]
+    has_day = (period > 0) & (p["start"] <= p["end"])
+    cycles = np.where(period > 0, np.floor((p["end"] - p["start"]) / np.where(period > 0, period, 1)) + 1, 0)
+    cycles = np.minimum(cycles, app.MAX_DAY_CYCLES)
+
+    starts = np.full((n, 1 + MAX_NIGHT_CYCLES), np.nan)
+    ends = np.full_like(starts, np.nan)
+    starts[:, 0] = np.where(has_day, p["start"], np.nan)
+    ends[:, 0] = p["start"] + cycles * period
+    night = p["night"]
+    inside_day = has_day[:, None] & (p["start"][:, None] <= night) & (night <= p["end"][:, None])
+    valid_night = ~np.isnan(night) & (night_length[:, None] > 0) & ~inside_day
+    starts[:, 1:] = np.where(valid_night, night, np.nan)
+    ends[:, 1:] = night + night_length[:, None]
+
+    # 開始時刻順に並べ（NaNは末尾）、前のブロックと重なるブロックを除く
+    order = np.argsort(np.where(np.isnan(starts), np.inf, starts), axis=1, kind="stable")
+    starts = np.take_along_axis(starts, order, axis=1)
+    ends = np.take_along_axis(ends, order, axis=1)
+    is_day = order == 0
+    last_end = np.full(n, -np.inf)
+    for b in range(starts.shape[1]):
+        keep = ~np.isnan(starts[:, b]) & (starts[:, b] >= last_end)
+        starts[:, b] = np.where(keep, starts[:, b], np.nan)
+        last_end = np.where(keep, ends[:, b], last_end)
+    return starts, ends, is_day
+
+
+def simulate_chunk(p, grid):
+    """候補ごと・時刻ごとの状態コード (候補, 時刻) を返す"""
+    starts, ends, is_day = day_blocks(p)
+    n, blocks = starts.shape
+    t = grid[None, :]
+    left = p["left"][:, None]
+    right = p["right"][:, None]
+    period = (p["left"] + p["right"] + p["off"])[:, None]
+    # サイクル内の区間が1種類だけの場合、連続する同じ遷移は省かれる（Schedule.transitions と同じ）
+    single = ((p["left"] > 0).astype(int) + (p["right"] > 0) + (p["off"] > 0) == 1)[:, None]
+
+    best_key = np.full((n, len(grid)), -np.inf)
+    state = np.full((n, len(grid)), IDLE, dtype=np.int8)
+    order = 0
+    for day in range(-DAYS_BEFORE, 1):
+        for b in range(blocks):
+            start = (starts[:, b] + day * DAY)[:, None]
+            end = (ends[:, b] + day * DAY)[:, None]
+            rel = t - start
+            inside = (rel >= 0) & (t < end)
+            after = t >= end
+            phase_time = np.where(is_day[:, b:b + 1], np.mod(rel, np.where(period > 0, period, 1)), rel)
+            segment = np.where(phase_time < left, LEFT, np.where(phase_time < left + right, RIGHT, OFF))
+            segment_start = np.where(segment == LEFT, 0, np.where(segment == RIGHT, left, left + right))
+            cycle_start = np.where(is_day[:, b:b + 1], rel - phase_time, 0)
+            last = np.where(single, start, start + cycle_start + segment_start)
+            last = np.where(inside, last, np.where(after, end, -np.inf))
+            last = np.where(np.isnan(start), -np.inf, last)
+            # 最後に起きた遷移が有効（同時刻なら後から積まれたブロックが優先）
+            key = last * 64 + order
+            newer = key > best_key
+            best_key = np.where(newer, key, best_key)
+            state = np.where(newer, np.where(inside, segment, IDLE), state).astype(np.int8)
+            order += 1
+    return np.where(p["enabled"][:, None], state, IDLE)
+
+
+def longest_gap(wet, step):
+    """水中ポンプがどちらも止まっている最長時間（日をまたいで連続する場合を含む）"""
+    n, size = wet.shape
+    doubled = np.concatenate([wet, wet], axis=1)
+    index = np.arange(2 * size)
+    last_wet = np.maximum.accumulate(np.where(doubled, index, -1), axis=1)
+    gaps = (index - last_wet)[:, size:]
+    longest = np.where(wet.any(axis=1), (gaps.max(axis=1) - 1).clip(min=0), size)
+    return np.where(wet.all(axis=1), 0, longest) * step
+
+
+def evaluate(candidates, resolution=60):
+    """
+    候補設定（画面から受け取る形式）の一覧を評価し、指標ごとの配列の辞書を返す。
+    resolution は時刻の刻み（秒）。秒単位の間隔を使う場合は 1 にします。
+    """
+    normalized = [app.normalize_settings(candidate) for candidate in candidates]
+    params = to_arrays(normalized)
+    grid = np.arange(0, DAY, resolution, dtype=float)
+    blocks = (DAYS_BEFORE + 1) * (1 + MAX_NIGHT_CYCLES)
+    chunk = max(1, CHUNK_CELLS // (len(grid) * blocks))
+    results = {name: np.zeros(len(normalized)) for name in METRICS}
+    for first in range(0, len(normalized), chunk):
+        part = slice(first, first + chunk)
+        state = simulate_chunk({key: value[part] for key, value in params.items()}, grid)
+        switches = 0
+        for channel, states in CHANNEL_STATES.items():
+            on = np.isin(state, states)
+            results[f"{channel}_on"][part] = on.sum(axis=1) * resolution
+            results[f"{channel}_duty"][part] = on.mean(axis=1)
+            # 1日を繰り返すので、末尾と先頭の間の切り替えも数える
+            count = (on != np.roll(on, 1, axis=1)).sum(axis=1)
+            results[f"{channel}_switches"][part] = count
+            switches = switches + count
+        results["switches"][part] = switches
+        results["longest_dry_gap"][part] = longest_gap(np.isin(state, (LEFT, RIGHT)), resolution)
+    return normalized, results
+
+
+def parse_sweep(spec):
+    """"名前=開始:終了:刻み"（終了を含む）または "名前=値1,値2,..." を (名前, 値の一覧) にする"""
+    name, values = spec.split("=", 1)
+    if ":" in values:
+        start, stop, step = (float(v) for v in values.split(":"))
+        return name, [round(v, 6) for v in np.arange(start, stop + step / 2, step)]
+    return name, [v if name.endswith("time") else float(v) for v in values.split(",")]
+
+
+def sweep_candidates(base, sweeps):
+    """基準の設定に、各パラメーターの値の全組み合わせを適用した候補を返す"""
+    names = [name for name, values in sweeps]
+    candidates = []
+    for combination in itertools.product(*(values for name, values in sweeps)):
+        candidate = dict(base)
+        candidate.update(zip(names, combination))
+        candidates.append(candidate)
+    return candidates
+
+
+def format_minutes(seconds):
+    return f"{seconds / 60:.1f}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("settings", nargs="*", help="評価する settings.json")
+    parser.add_argument("--base", help="--sweep の基準にする settings.json（既定は初期設定）")
+    parser.add_argument("--sweep", action="append", default=[],
+                        help="名前=開始:終了:刻み または 名前=値1,値2,...（複数指定で全組み合わせ）")
+    parser.add_argument("--candidates", help="候補設定のリスト（JSON配列）")
+    parser.add_argument("--resolution", type=float, default=60, help="時刻の刻み（秒）")
+    parser.add_argument("--sort", default="longest_dry_gap", choices=METRICS, help="並べ替える指標（昇順）")
+    parser.add_argument("--top", type=int, default=10, help="表示する件数")
+    parser.add_argument("--output", help="全候補の結果を書き出すCSVファイル")
+    args = parser.parse_args(argv)
+
+    candidates = []
+    for path in args.settings:
+        with open(path) as f:
+            candidates.append(json.load(f))
+    if args.candidates:
+        with open(args.candidates) as f:
+            candidates.extend(json.load(f))
+    if args.sweep:
+        base = dict(app.DEFAULT_SETTINGS)
+        if args.base:
+            with open(args.base) as f:
+                base.update(json.load(f))
+        candidates.extend(sweep_candidates(base, [parse_sweep(spec) for spec in args.sweep]))
+    if not candidates:
+        parser.error("no candidates (give settings files, --candidates or --sweep)")
+
+    started = time.perf_counter()
+    normalized, results = evaluate(candidates, args.resolution)
+    elapsed = time.perf_counter() - started
+    print(f"{len(normalized)} candidates evaluated in {elapsed:.2f} s", file=sys.stderr)
+
+    swept = [spec.split("=", 1)[0] for spec in args.sweep] or ["interval_output2_on", "interval_output3_on",
+                                                                "interval_both_off"]
+    order = np.argsort(results[args.sort], kind="stable")
+    print("  ".join(f"{name:>20}" for name in swept) +
+          "  left_on[min]  right_on[min]  air_duty  dry_gap[min]  switches")
+    for i in order[:args.top]:
+        settings = normalized[i]
+        print("  ".join(f"{str(settings.get(name)):>20}" for name in swept) +
+              f"  {format_minutes(results['left_on'][i]):>12}  {format_minutes(results['right_on'][i]):>13}"
+              f"  {results['air_duty'][i]:>8.3f}  {format_minutes(results['longest_dry_gap'][i]):>12}"
+              f"  {int(results['switches'][i]):>8}")
+
+    if args.output:
+        with open(args.output, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["settings"] + list(METRICS))
+            for i, settings in enumerate(normalized):
+                writer.writerow([json.dumps(settings, sort_keys=True)] + [results[name][i] for name in METRICS])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())